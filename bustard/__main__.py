@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""run a WSGI app with a server::
+
+    python -m bustard hello:app --server threaded --threads 20
+"""
+import argparse
+import importlib
+import os
+import sys
+
+from .app import Bustard
+from .servers import get_server_adapter, SERVERS
+
+
+def import_app(path):
+    """``module:name`` -> the object, ``name`` defaults to ``app``"""
+    module_name, _, name = path.partition(':')
+    if os.getcwd() not in sys.path:
+        sys.path.insert(0, os.getcwd())
+    module = importlib.import_module(module_name)
+    try:
+        return getattr(module, name or 'app')
+    except AttributeError:
+        raise ValueError('{!r} has no attribute {!r}'.format(
+            module_name, name or 'app'
+        ))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bustard',
+                                     description='run a WSGI app')
+    parser.add_argument('app', help='module:name of the app, e.g. hello:app')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--server', choices=sorted(SERVERS),
+                        help='default is bustard, prefork with --workers')
+    parser.add_argument('--workers', type=int,
+                        help='number of processes of prefork server')
+    parser.add_argument('--threads', type=int,
+                        help='number of threads handling requests')
+    parser.add_argument('--backlog', type=int, help='listen backlog')
+    parser.add_argument('--keepalive', type=float,
+                        help='keep-alive timeout in seconds, 0 disables it')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    app = import_app(args.app)
+    server = args.server or ('prefork' if args.workers else 'bustard')
+    options = dict(server=server, workers=args.workers,
+                   threads=args.threads, backlog=args.backlog,
+                   keepalive=args.keepalive)
+    if isinstance(app, Bustard):
+        # Bustard.run preloads templates
+        app.run(args.host, args.port, **options)
+        return
+    httpd = get_server_adapter(host=args.host, port=args.port, **options)
+    print('{}: Serving HTTP on {} ...\n'.format(
+        httpd.__class__.__name__, (args.host, args.port)
+    ))
+    httpd.run(app)
+
+
+if __name__ == '__main__':
+    main()
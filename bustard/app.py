@@ -7,10 +7,12 @@ from .constants import CONFIGURE
 from .exceptions import HTTPException, NotFound
 from .http import Request, Response
 from .router import Router
-from .template import Template
+from .template import (
+    LRUCache, Template, TemplateCache, TemplateProfiler, TemplateSyntaxError
+)
 from .testing import Client
 from .utils import to_bytes
-from .servers import WSGIRefServer
+from .servers import get_server_adapter
 from . import sessions
 
 
@@ -29,6 +31,11 @@ class Bustard:
         else:
             self.template_default_context = {}
         self.template_default_context.setdefault('url_for', self.url_for)
+        self.template_cache = TemplateCache()
+        # backend of template {% cache %} tag
+        self.fragment_cache = LRUCache()
+        # used by templates if TEMPLATE_PROFILE is enabled
+        self.template_profiler = TemplateProfiler()
 
         self._before_request_hooks = []
         self._before_request_hooks.extend(self.before_request_hooks)
@@ -42,12 +49,70 @@ class Bustard:
     def config(self):
         return self._config
 
-    def render_template(self, template_name, **kwargs):
-        return render_template(
+    def get_template(self, template_name, enable_async=False):
+        """templates are cached in ``template_cache``, with ``DEBUG`` config
+        they're loaded again to show changes of template files
+        """
+        if self.config['DEBUG']:
+            self.template_cache.clear()
+        return get_template(
             template_name, template_dir=self.template_dir,
             default_context=self.template_default_context,
-            context=kwargs
-        ).encode('utf-8')
+            template_cache=self.template_cache,
+            fragment_cache=self.fragment_cache,
+            sandbox=self.config['TEMPLATE_SANDBOX'],
+            enable_async=enable_async,
+            profiler=(self.template_profiler
+                      if self.config['TEMPLATE_PROFILE'] else None)
+        )
+
+    def template_profile_report(self, limit=None):
+        """render time of templates sorted by cumulative time,
+        templates loaded after ``TEMPLATE_PROFILE`` is enabled are profiled
+        """
+        return self.template_profiler.report(limit)
+
+    def preload_templates(self):
+        """parse and compile all templates in ``template_dir`` into
+        ``template_cache``, templates included or extended are loaded too.
+
+        call it before the server forks worker processes, so workers share
+        compiled templates.
+
+        :raise TemplateSyntaxError: if any template is invalid
+        :return: names of loaded templates
+        """
+        if not self.template_dir:
+            return []
+        names = []
+        errors = []
+        for root, dirs, files in os.walk(self.template_dir):
+            dirs[:] = sorted(x for x in dirs if not x.startswith('.'))
+            for filename in sorted(files):
+                if filename.startswith('.'):
+                    continue
+                name = os.path.relpath(os.path.join(root, filename),
+                                       self.template_dir)
+                try:
+                    self.get_template(name)
+                except (TemplateSyntaxError, OSError, ValueError) as ex:
+                    errors.append('{}: {}'.format(name, ex))
+                else:
+                    names.append(name)
+        if errors:
+            raise TemplateSyntaxError(
+                'failed to load templates:\n' + '\n'.join(errors)
+            )
+        return names
+
+    def render_template(self, template_name, **kwargs):
+        template = self.get_template(template_name)
+        return template.render(**kwargs).encode('utf-8')
+
+    async def render_template_async(self, template_name, **kwargs):
+        template = self.get_template(template_name, enable_async=True)
+        html = await template.render_async(**kwargs)
+        return html.encode('utf-8')
 
     def url_for(self, func_name, _request=None, _external=False, **kwargs):
         url = self._router.url_for(func_name, **kwargs)
@@ -65,7 +130,6 @@ class Bustard:
 
     def __call__(self, environ, start_response):
         """for wsgi server"""
-        self.start_response = start_response
         path = environ['PATH_INFO']
         method = environ['REQUEST_METHOD']
         func, methods, func_kwargs = self.url_resolve(path)
@@ -85,7 +149,7 @@ class Bustard:
         except HTTPException as ex:
             response = ex.response
 
-        return self._start_response(response)
+        return self._start_response(response, start_response)
 
     def handle_view(self, request, view_func, func_kwargs):
         result = view_func(request, **func_kwargs)
@@ -99,14 +163,17 @@ class Bustard:
             response = Response(result)
         return response
 
-    def _start_response(self, response):
+    def _start_response(self, response, start_response):
         body = response.body
         status_code = response.status
         headers_list = response.headers_list
-        self.start_response(status_code, headers_list)
+        start_response(status_code, headers_list)
 
         if isinstance(body, collections.Iterator):
             return (to_bytes(x) for x in body)
+        elif hasattr(body, 'filelike'):
+            # wsgi.file_wrapper is returned to the server as it is
+            return body
         else:
             return [to_bytes(body)]
 
@@ -162,17 +229,70 @@ class Bustard:
     def test_client(self):
         return Client(self)
 
-    def run(self, host='127.0.0.1', port=5000):
-        address = (host, port)
-        httpd = WSGIRefServer(host, port)
-        print('WSGIServer: Serving HTTP on %s ...\n' % str(address))
+    def run(self, host='127.0.0.1', port=5000, server=None, workers=None,
+            threads=None, backlog=None, keepalive=None, **options):
+        """run the app with a server
+
+        :param server: ``'bustard'``, ``'threaded'``, ``'prefork'``,
+                       ``'asyncio'``, ``'wsgiref'`` (default, ``'prefork'``
+                       if ``workers`` is set, ``'threaded'`` if ``threads``
+                       is set), ``'werkzeug'`` or a
+                       ``servers.ServerAdapter`` subclass
+        :param workers: number of pre-forked worker processes
+        :param threads: number of threads handling requests
+        :param backlog: listen backlog
+        :param keepalive: keep-alive timeout in seconds
+        :param options: other options of the server adapter
+        """
+        if self.config['TEMPLATE_PRELOAD']:
+            self.preload_templates()
+        if server is None:
+            if workers:
+                server = 'prefork'
+            elif threads:
+                server = 'threaded'
+            else:
+                server = 'wsgiref'
+        httpd = get_server_adapter(
+            server, host, port, workers=workers, threads=threads,
+            backlog=backlog, keepalive=keepalive, **options
+        )
+        print('{}: Serving HTTP on {} ...\n'.format(
+            httpd.__class__.__name__, (host, port)
+        ))
         httpd.run(self)
 
 
+def get_template(template_name, template_dir='', default_context=None,
+                 template_cache=None, **kwargs):
+    path = os.path.join(template_dir, template_name)
+    key = ('template', os.path.abspath(path))
+    if kwargs.get('sandbox'):
+        key += ('sandbox',)
+    if kwargs.get('enable_async'):
+        key += ('async',)
+    if kwargs.get('profiler') is not None:
+        key += ('profile',)
+    if template_cache is not None:
+        template = template_cache.get(key)
+        if template is not None:
+            return template
+
+    with open(path, encoding='utf-8') as f:
+        template = Template(f.read(), default_context=default_context,
+                            template_dir=template_dir,
+                            template_cache=template_cache,
+                            name=template_name, **kwargs)
+    if template_cache is not None:
+        template_cache.set(key, template)
+    return template
+
+
 def render_template(template_name, template_dir='', default_context=None,
-                    context=None, **kwargs):
-    with open(os.path.join(template_dir, template_name),
-              encoding='utf-8') as f:
-        return Template(f.read(), default_context=default_context,
-                        template_dir=template_dir, **kwargs
-                        ).render(**context)
+                    context=None, template_cache=None, **kwargs):
+    template = get_template(
+        template_name, template_dir=template_dir,
+        default_context=default_context, template_cache=template_cache,
+        **kwargs
+    )
+    return template.render(**context)
@@ -54,6 +54,31 @@ TEMPLATE_BUILTIN_FUNC_WHITELIST = (
     'object',
     'callable',
 )
+# 沙箱模式下不可用的内置函数
+TEMPLATE_SANDBOX_UNSAFE_FUNC = (
+    'getattr',
+    'setattr',
+    'delattr',
+    'hasattr',
+    'type',
+    'object',
+)
+# 沙箱模式下禁止访问的属性（以及所有以 _ 开头的属性）
+TEMPLATE_SANDBOX_UNSAFE_ATTR = (
+    'format',
+    'format_map',
+    'mro',
+    'gi_frame',
+    'gi_code',
+    'cr_frame',
+    'cr_code',
+    'ag_frame',
+    'ag_code',
+    'f_globals',
+    'f_locals',
+    'f_builtins',
+    'func_globals',
+)
 
 HTTP_STATUS_CODES = {
     100:    'Continue',
@@ -123,6 +148,12 @@ CONFIGURE = {
     'SESSION_COOKIE_PATH': '/',
     'SESSION_COOKIE_SECURE': False,
     'SESSION_COOKIE_HTTPONLY': True,
+    # parse and compile all templates before serving
+    'TEMPLATE_PRELOAD': False,
+    # compile templates in sandbox mode
+    'TEMPLATE_SANDBOX': False,
+    # collect render time of templates, see Bustard.template_profile_report
+    'TEMPLATE_PROFILE': False,
 }
 
 NOTFOUND_HTML = b"""
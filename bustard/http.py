@@ -120,8 +120,13 @@ class Request:
             'multipart/form-data',
         ]:
             content = b''
+        elif self.content_length:
+            content = self.stream.read(int(self.content_length))
+        elif self.environ.get('wsgi.input_terminated'):
+            # chunked body, read until the end
+            content = self.stream.read()
         else:
-            content = self.stream.read(int(self.content_length or 0))
+            content = b''
         self._content = content
         if as_text:
             content = content.decode(encoding)
@@ -6,6 +6,9 @@ from . import wsgi_server
 
 
 class ServerAdapter(metaclass=abc.ABCMeta):
+    # options of get_server_adapter() supported by the server
+    tuning_options = ('threads', 'backlog', 'keepalive_timeout')
+
     def __init__(self, host='127.0.0.1', port=5000, **options):
         self.host = host
         self.port = port
@@ -17,15 +20,58 @@ class ServerAdapter(metaclass=abc.ABCMeta):
 
 
 class BustardServer(ServerAdapter):
+    """SIGTERM/SIGINT: graceful shutdown, SIGHUP/SIGUSR2: reload, the
+    process is re-executed and inherits the listening socket
+    """
 
     def run(self, app):
         httpd = wsgi_server.make_server(
+            (self.host, self.port), app, fd=wsgi_server.inherited_fd(),
+            **self.options
+        )
+        wsgi_server.run_server(httpd)
+
+
+class ThreadedServer(BustardServer):
+    """``ThreadPoolWSGIServer``, options: threads (default 10), queue_size,
+    keepalive_timeout ...
+    """
+
+    def run(self, app):
+        self.options.setdefault('threads', 10)
+        super().run(app)
+
+
+class PreforkServer(ServerAdapter):
+    """options: workers, threads, reuse_port, graceful_timeout,
+    see ``PreforkMaster`` for signals
+    """
+    tuning_options = ('workers',) + ServerAdapter.tuning_options
+
+    def run(self, app):
+        master = wsgi_server.PreforkMaster(
             (self.host, self.port), app, **self.options
         )
-        httpd.serve_forever()
+        master.run()
+
+
+class AsyncioServer(ServerAdapter):
+    """asyncio server (uvloop if it's installed), WSGI apps run in a thread
+    pool, ASGI apps in the event loop.
+
+    options: threads, interface, keepalive_timeout, max_connections ...
+    """
+
+    def run(self, app):
+        httpd = wsgi_server.make_server(
+            (self.host, self.port), app, fd=wsgi_server.inherited_fd(),
+            server_class=wsgi_server.AsyncioWSGIServer, **self.options
+        )
+        wsgi_server.run_server(httpd)
 
 
 class WSGIRefServer(ServerAdapter):
+    tuning_options = ()
 
     def run(self, app):
         httpd = wsgiref.simple_server.make_server(
@@ -35,7 +81,51 @@ class WSGIRefServer(ServerAdapter):
 
 
 class WerkzeugfServer(ServerAdapter):
+    tuning_options = ()
 
     def run(self, app):
         from werkzeug.serving import run_simple
         run_simple(self.host, self.port, app, **self.options)
+
+
+SERVERS = {
+    'bustard': BustardServer,
+    'threaded': ThreadedServer,
+    'prefork': PreforkServer,
+    'asyncio': AsyncioServer,
+    'wsgiref': WSGIRefServer,
+    'werkzeug': WerkzeugfServer,
+}
+
+
+def get_server_adapter(server='bustard', host='127.0.0.1', port=5000,
+                       workers=None, threads=None, backlog=None,
+                       keepalive=None, **options):
+    """create a server adapter
+
+    :param server: name in ``SERVERS`` or ``ServerAdapter`` subclass
+    :param workers: number of processes of ``prefork`` server
+    :param threads: number of threads handling requests
+    :param backlog: listen backlog
+    :param keepalive: keep-alive timeout in seconds, 0 disables keep-alive
+    :param options: other options of the server adapter
+    """
+    if isinstance(server, str):
+        try:
+            server = SERVERS[server]
+        except KeyError:
+            raise ValueError('unknown server {!r}, choices: {}'.format(
+                server, ', '.join(sorted(SERVERS))
+            ))
+    for param, name, value in (
+            ('workers', 'workers', workers), ('threads', 'threads', threads),
+            ('backlog', 'backlog', backlog),
+            ('keepalive', 'keepalive_timeout', keepalive)):
+        if value is None:
+            continue
+        if name not in server.tuning_options:
+            raise ValueError('{} is not supported by {}'.format(
+                param, server.__name__
+            ))
+        options[name] = value
+    return server(host, port, **options)
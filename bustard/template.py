@@ -12,19 +12,36 @@ support:
 * {# ... #}
 * {% if xx %} {% elif yy %} {% else %} {% endif %}
 * {% for x in lst %} {% endfor %}
+* {{ await foo() }} {% async for x in lst %} {% endfor %} (``enable_async``)
 * {% include "path/to/b.tpl" %}
 * {% extends "path/to/b.tpl" %}
 * {% block body %} {% endblock body %}
+* {% cache "sidebar" 3600 %} {% endcache %}
+* {% macro field(name, value='') %} {{ caller() }} {% endmacro %}
+* {{ field('a') }} {% call field('b') %} {% endcall %}
 
 """
+import ast
+import asyncio
 import builtins
+import collections
 import os
 import re
+import threading
+import time
+import zlib
 
-from .constants import TEMPLATE_BUILTIN_FUNC_WHITELIST
+from .constants import (
+    TEMPLATE_BUILTIN_FUNC_WHITELIST, TEMPLATE_SANDBOX_UNSAFE_ATTR,
+    TEMPLATE_SANDBOX_UNSAFE_FUNC,
+)
 from .utils import to_text
 
 
+class TemplateSyntaxError(Exception):
+    pass
+
+
 class CodeBuilder:
     INDENT_STEP = 4
 
@@ -46,9 +63,9 @@ class CodeBuilder:
     def backward_indent(self):
         self.indent_level -= self.INDENT_STEP
 
-    def _compile(self):
+    def _compile(self, filename='<source>'):
         assert self.indent_level == 0
-        self._code = compile(str(self), '<source>', 'exec')
+        self._code = compile(str(self), filename, 'exec')
         return self._code
 
     def _exec(self, globals_dict=None):
@@ -65,6 +82,319 @@ class CodeBuilder:
         return self.__str__()
 
 
+class TemplateCache:
+    """parsed templates, shared by all templates which include them"""
+
+    def __init__(self):
+        self._templates = {}
+
+    def get(self, key, default=None):
+        return self._templates.get(key, default)
+
+    def set(self, key, template):
+        self._templates[key] = template
+
+    def clear(self):
+        self._templates.clear()
+
+    def __contains__(self, key):
+        return key in self._templates
+
+    def __len__(self):
+        return len(self._templates)
+
+
+class Undefined:
+    """value of names which are neither in the context nor in the default
+    context, raise NameError when it is used
+    """
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def _fail(self, *args, **kwargs):
+        raise NameError('name {!r} is not defined'.format(self.name))
+
+    __str__ = __bool__ = __len__ = __iter__ = __contains__ = _fail
+    __call__ = __getitem__ = __hash__ = _fail
+    __eq__ = __ne__ = __lt__ = __le__ = __gt__ = __ge__ = _fail
+    __add__ = __radd__ = __sub__ = __rsub__ = __mul__ = __rmul__ = _fail
+    __truediv__ = __floordiv__ = __mod__ = __neg__ = __pos__ = _fail
+
+    def __getattr__(self, name):
+        self._fail()
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.name)
+
+
+class LRUCache:
+    """in-process least recently used cache, items can expire after
+    ``ttl`` seconds
+
+    other fragment cache backends should implement
+    ``get(key)``, ``set(key, value, ttl=None)`` and ``delete(key)``
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._data = collections.OrderedDict()   # key -> (expires, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return default
+            if expires is not None and expires <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self._data)
+
+
+default_fragment_cache = LRUCache()
+
+
+class TemplateProfiler:
+    """collect render time of templates, blocks and included templates
+
+    used by ``Template(profiler=...)``, timers are added to generated code
+    when templates are compiled, templates without profiler have no overhead.
+    """
+
+    def __init__(self, timer=time.perf_counter):
+        self.timer = timer
+        self._stats = {}   # name -> [calls, cumulative time, max time]
+        self._lock = threading.Lock()
+
+    def record(self, name, elapsed):
+        with self._lock:
+            stat = self._stats.get(name)
+            if stat is None:
+                self._stats[name] = [1, elapsed, elapsed]
+            else:
+                stat[0] += 1
+                stat[1] += elapsed
+                if elapsed > stat[2]:
+                    stat[2] = elapsed
+
+    @property
+    def stats(self):
+        """{name: (calls, cumulative time, max time)}"""
+        with self._lock:
+            return {k: tuple(v) for k, v in self._stats.items()}
+
+    def clear(self):
+        with self._lock:
+            self._stats.clear()
+
+    def report(self, limit=None):
+        """text report sorted by cumulative time"""
+        stats = sorted(self.stats.items(), key=lambda x: x[1][1],
+                       reverse=True)
+        lines = ['{:>8} {:>12} {:>12} {:>12}  {}'.format(
+            'calls', 'cumtime(ms)', 'percall(ms)', 'max(ms)', 'name'
+        )]
+        for name, (calls, total, max_time) in stats[:limit]:
+            lines.append('{:>8} {:>12.3f} {:>12.3f} {:>12.3f}  {}'.format(
+                calls, total * 1000, total * 1000 / calls, max_time * 1000,
+                name
+            ))
+        return '\n'.join(lines)
+
+
+class Node:
+    """node of the parsed template tree
+
+    * text: ``value`` is the text
+    * output: {{ value }}
+    * super: {{ block.super }}
+    * if: ``body`` is a list of ``branch`` nodes, ``value`` of a branch is
+      its condition (``None`` for ``else``)
+    * for, cache, macro, call: {% tag value %} body {% endtag %}
+    * async: {% async for value %} body {% endfor %}
+    * block: ``value`` is the name of the block
+    * include: ``value`` is the path of the included template
+    * break
+    * template: root node, ``value`` is the path of the extended template
+    """
+    __slots__ = ('tag', 'value', 'body', 'lineno')
+
+    def __init__(self, tag, value=None, body=None, lineno=0):
+        self.tag = tag
+        self.value = value
+        self.body = body
+        self.lineno = lineno
+
+    def replace(self, body):
+        return self.__class__(self.tag, self.value, body, self.lineno)
+
+    def walk(self):
+        yield self
+        for node in self.body or ():
+            yield from node.walk()
+
+    def __repr__(self):
+        return '{}({!r}, {!r}, {!r})'.format(
+            self.__class__.__name__, self.tag, self.value, self.body
+        )
+
+
+class Parser:
+    """parse tokens of template into a tree of nodes"""
+    # tag -> tags which end it
+    end_tags = {
+        'if': ('elif', 'else', 'endif'),
+        'for': ('endfor',),
+        'block': ('endblock',),
+        'cache': ('endcache',),
+        'macro': ('endmacro',),
+        'call': ('endcall',),
+        # {% async for ... %}
+        'async': ('endfor',),
+    }
+    single_tags = ('include', 'extends', 'break')
+
+    def __init__(self, tokens, name='<template>'):
+        # [(type, value, lineno), ...]
+        self.tokens = tokens
+        self.name = name
+        self.pos = 0
+        self.extends = None
+
+    def error(self, message, lineno):
+        return TemplateSyntaxError('{}:{}: {}'.format(
+            self.name, lineno, message
+        ))
+
+    def parse(self):
+        body, _, _ = self.parse_body()
+        return Node('template', self.extends, body)
+
+    def parse_body(self, end_tags=(), start_tag=None):
+        """parse nodes until one of ``end_tags``
+
+        :return: (nodes, end tag, arguments of end tag)
+        """
+        body = []
+        while self.pos < len(self.tokens):
+            _type, value, lineno = self.tokens[self.pos]
+            self.pos += 1
+            if _type == 'text':
+                if body and body[-1].tag == 'text':
+                    # merge adjacent strings, e.g. text around comments
+                    body[-1].value += value
+                elif value:
+                    body.append(Node('text', value, lineno=lineno))
+            elif _type == 'variable':
+                if value == 'block.super':
+                    body.append(Node('super', lineno=lineno))
+                else:
+                    body.append(Node('output', value, lineno=lineno))
+            elif _type == 'tag':
+                tag_name, args = (value.split(None, 1) + [''])[:2]
+                if tag_name in end_tags:
+                    return body, tag_name, args
+                node = self.parse_tag(tag_name, args, lineno)
+                if node is not None:
+                    body.append(node)
+
+        if end_tags:
+            raise self.error('unclosed "{}" tag'.format(start_tag),
+                             self.tokens[-1][2] if self.tokens else 0)
+        return body, None, None
+
+    def parse_tag(self, tag_name, args, lineno):
+        if tag_name == 'if':
+            return self.parse_if(args, lineno)
+        elif tag_name in self.end_tags:
+            body, _, end_args = self.parse_body(self.end_tags[tag_name],
+                                                tag_name)
+            if tag_name == 'block':
+                args = args.split()[0] if args else ''
+                if end_args and end_args != args:
+                    raise self.error('"endblock {}" doesn\'t match '
+                                     '"block {}"'.format(end_args, args),
+                                     lineno)
+            return Node(tag_name, args, body, lineno)
+        elif tag_name in self.single_tags:
+            if tag_name == 'extends':
+                self.extends = args.strip('\'"')
+                return
+            if tag_name == 'include':
+                args = args.strip('\'"')
+            return Node(tag_name, args, lineno=lineno)
+        raise self.error('unexpected tag "{}"'.format(tag_name), lineno)
+
+    def parse_if(self, condition, lineno):
+        branches = []
+        while True:
+            body, end_tag, args = self.parse_body(self.end_tags['if'], 'if')
+            branches.append(Node('branch', condition, body, lineno))
+            if end_tag == 'endif':
+                return Node('if', None, branches, lineno)
+            if condition is None:
+                raise self.error('"{}" after "else"'.format(end_tag), lineno)
+            condition = args if end_tag == 'elif' else None
+
+
+def override_blocks(nodes, blocks):
+    """replace blocks in ``nodes`` (parent template) with ``blocks``
+    (blocks of child template)
+    """
+    result = []
+    for node in nodes:
+        if node.tag == 'block' and node.value in blocks:
+            block = blocks[node.value]
+            body = replace_block_super(block.body, node.body)
+            result.append(block.replace(body))
+        elif node.body:
+            result.append(node.replace(override_blocks(node.body, blocks)))
+        else:
+            result.append(node)
+    return result
+
+
+def replace_block_super(nodes, parent_nodes):
+    """{{ block.super }} -> content of the block in parent template"""
+    result = []
+    for node in nodes:
+        if node.tag == 'super':
+            result.extend(parent_nodes)
+        elif node.body:
+            result.append(node.replace(
+                replace_block_super(node.body, parent_nodes)
+            ))
+        else:
+            result.append(node)
+    return result
+
+
 class Template:
     TOKEN_VARIABLE_START = '{{'
     TOKEN_VARIABLE_END = '}}'
@@ -73,13 +403,23 @@ class Template:
     TOKEN_COMMENT_START = '{#'
     TOKEN_COMMENT_END = '#}'
     FUNC_WHITELIST = TEMPLATE_BUILTIN_FUNC_WHITELIST
+    SANDBOX_UNSAFE_FUNC = TEMPLATE_SANDBOX_UNSAFE_FUNC
+    SANDBOX_UNSAFE_ATTR = TEMPLATE_SANDBOX_UNSAFE_ATTR
+    parser_class = Parser
 
     def __init__(self, text, default_context=None,
                  pre_compile=True,
                  indent=0, template_dir='',
                  func_name='__render_function',
                  result_var='__result',
-                 auto_escape=True
+                 auto_escape=True,
+                 template_cache=None,
+                 fragment_cache=None,
+                 nested=False,
+                 name='<template>',
+                 sandbox=False,
+                 enable_async=False,
+                 profiler=None
                  ):
         self.re_tokens = re.compile(r'''(?x)(
         (?:{token_variable_start} .+? {token_variable_end})
@@ -114,199 +454,697 @@ class Template:
             token_tag_start=re.escape(self.TOKEN_TAG_START),
             token_tag_end=re.escape(self.TOKEN_TAG_END)
         ), re.VERBOSE)
-        # {% extends "base.html" %}
-        self.re_extends = re.compile(r'''
-            ^{token_tag_start}\s+extends\s+[\'"](?P<path>[^\'"]+)[\'"]\s+
-            {token_tag_end}
-        '''.format(
-            token_tag_start=re.escape(self.TOKEN_TAG_START),
-            token_tag_end=re.escape(self.TOKEN_TAG_END),
-        ), re.VERBOSE)
-        # {% block header %}...{% endblock header %}
-        self.re_block = re.compile(r'''
-            {token_tag_start}\s+block\s+(?P<name>\w+)\s+{token_tag_end}
-            (?P<code>.*?)
-            {token_tag_start}\s+endblock(?:\s+\1)?\s+{token_tag_end}
-        '''.format(
-            token_tag_start=re.escape(self.TOKEN_TAG_START),
-            token_tag_end=re.escape(self.TOKEN_TAG_END),
-        ), re.DOTALL | re.VERBOSE)
-        # {{ block.super }}
-        self.re_block_super = re.compile(r'''
-            {token_variable_start}\s+block\.super\s+
-            {token_variable_end}
-        '''.format(
-            token_variable_start=re.escape(self.TOKEN_VARIABLE_START),
-            token_variable_end=re.escape(self.TOKEN_VARIABLE_END),
-        ), re.VERBOSE)
 
+        self.sandbox = sandbox
         self.default_context = {
             k: v
             for k, v in builtins.__dict__.items()
-            if k in self.FUNC_WHITELIST
+            if k in self.FUNC_WHITELIST and not (
+                sandbox and k in self.SANDBOX_UNSAFE_FUNC
+            )
         }
         self.default_context.update({
             'escape': escape,
             'noescape': noescape,
-            'to_text': noescape,
+            'to_text': to_text,
+            '__cache_fragment': self.cache_fragment,
+            '__cache_fragment_async': self.cache_fragment_async,
         })
         if default_context is not None:
             self.default_context.update(default_context)
+        # TemplateProfiler, timers are only generated if it isn't None
+        self.profiler = profiler
+        if profiler is not None:
+            self.default_context.update({
+                '__profile_timer': profiler.timer,
+                '__profile_record': profiler.record,
+            })
+        self._profile_timers = 0
+        self.name = name
         self.base_dir = template_dir
         self.func_name = func_name
         self.result_var = result_var
         self.auto_escape = auto_escape
+        # compile to ``async def`` functions, see ``render_async``
+        self.enable_async = enable_async
+        if template_cache is None:
+            template_cache = TemplateCache()
+        self.template_cache = template_cache
+        if fragment_cache is None:
+            fragment_cache = default_fragment_cache
+        self.fragment_cache = fragment_cache
+        # stack of functions defined by {% cache %}, {% macro %}, {% call %}
+        self._functions = []
+        # included templates are defined by the outermost template
+        self.nested = nested
+        # func_name -> included template, for the whole template tree
+        self.includes = collections.OrderedDict()
+        # text of the template if it has no variables and tags
+        self.static_text = None
+        self._texts = []
+        self._is_static = True
+        # names used in expressions and names assigned by the render function
+        self.names_loaded = set()
+        self.names_stored = set()
+        self.context_names = []
 
-        self.buffered = []   # store common string
+        self.buffered = []   # store python expressions
+        self.buffered_text = []  # store common string not in buffered yet
+        self._last_flush = (None, [])  # (index in code, buffered)
         self.code_builder = code_builder = CodeBuilder(indent=indent)
-        # def func_name():
+        # def func_name(__context):
+        #     __get = __context.get
+        #     name = __get('name', __default_name)
+        #     ...
         #     result = []
-        code_builder.add_line('def {}():', func_name)
+        #     def func_name_included():
+        #         ...
+        prefix = 'async def' if enable_async else 'def'
+        if nested:
+            # included templates use names of the outermost function
+            code_builder.add_line('{} {}():', prefix, func_name)
+        else:
+            code_builder.add_line('{} {}(__context):', prefix, func_name)
         code_builder.forward_indent()
+        self.prologue = CodeBuilder(indent=code_builder.indent_level)
+        code_builder.add(self.prologue)
         code_builder.add_line('{} = []', self.result_var)
+        # bound methods, avoid attribute lookups when rendering
+        code_builder.add_line('_append = {}.append', self.result_var)
+        code_builder.add_line('_extend = {}.extend', self.result_var)
+        self.definitions = CodeBuilder(indent=code_builder.indent_level)
+        code_builder.add(self.definitions)
 
         self.tpl_text = text
-        self.parse_text(text)
-
-    def parse_text(self, text):
-        # if has extends, replace parent template with current blocks
-        extends_text = self.handle_extends(text)
-        if extends_text is not None:
-            return self.parse_text(extends_text)
-
-        tokens = self.re_tokens.split(text)
-        handlers = (
-            (self.re_variable.match, self._handle_variable),   # {{ variable }}
-            (self.re_tag.match, self._handle_tag),             # {% tag %}
-            (self.re_comment.match, self._handle_comment),     # {# comment #}
-        )
-        default_handler = self._handle_string                  # common string
+        self.tree = self.resolve_extends(self.parse(text, name))
+        timer = self._start_profile_timer()
+        self.compile_nodes(self.tree.body)
+        self.flush_buffer()
+        if timer is None:
+            code_builder.add_line('return "".join({})', self.result_var)
+        else:
+            code_builder.add_line('__text = "".join({})', self.result_var)
+            self._end_profile_timer(timer, 'template {}'.format(name))
+            code_builder.add_line('return __text')
+        code_builder.backward_indent()
+
+        if self._is_static:
+            self.static_text = ''.join(self._texts)
+        if not self.nested:
+            for _template in self.includes.values():
+                self.definitions.add(_template.code_builder)
+            self._add_prologue()
+
+        self._code = None
+        self.render_function = None
+        if pre_compile:
+            self.compile()
+
+    def tokenize(self, text):
+        """split text into tokens: [(type, value, lineno), ...]"""
+        tokens = []
+        lineno = 1
+        for token in self.re_tokens.split(text):
+            if self.re_variable.match(token):      # {{ variable }}
+                tokens.append(('variable', self.strip_token(
+                    token, self.TOKEN_VARIABLE_START, self.TOKEN_VARIABLE_END
+                ).strip(), lineno))
+            elif self.re_tag.match(token):         # {% tag %}
+                tokens.append(('tag', self.strip_token(
+                    token, self.TOKEN_TAG_START, self.TOKEN_TAG_END
+                ).strip(), lineno))
+            elif self.re_comment.match(token):     # {# comment #}
+                pass
+            else:                                  # common string
+                tokens.append(('text', token, lineno))
+            lineno += token.count('\n')
+        return tokens
+
+    def parse(self, text, name):
+        return self.parser_class(self.tokenize(text), name=name).parse()
+
+    def load_tree(self, path):
+        """parse template file and resolve its extends,
+        parsed templates are stored in ``template_cache``
+        """
+        key = ('tree', os.path.abspath(path))
+        tree = self.template_cache.get(key)
+        if tree is None:
+            with open(path, encoding='utf-8') as fp:
+                text = fp.read()
+            name = os.path.relpath(path, self.base_dir)
+            tree = self.resolve_extends(self.parse(text, name))
+            self.template_cache.set(key, tree)
+        return tree
+
+    def resolve_extends(self, tree):
+        """merge blocks of the template into the template it extends,
+        macros defined outside blocks are kept (and override macros of the
+        parent with the same name)
+        """
+        if tree.value is None:
+            return tree
+        parent = self.load_tree(os.path.join(self.base_dir, tree.value))
+        blocks = {
+            node.value: node
+            for node in tree.walk() if node.tag == 'block'
+        }
+        macros = [node for node in tree.body if node.tag == 'macro']
+        return Node('template', None,
+                    override_blocks(parent.body, blocks) + macros)
+
+    def compile_nodes(self, nodes):
+        for node in nodes:
+            getattr(self, '_compile_' + node.tag)(node)
+
+    def _add_prologue(self):
+        """bind all names used by the template to local variables"""
+        self.context_names = sorted(self.names_loaded - self.names_stored)
+        if not self.context_names:
+            return
+        self.prologue.add_line('__get = __context.get')
+        for name in self.context_names:
+            self.prologue.add_line("{0} = __get('{0}', __default_{0})", name)
 
-        for token in tokens:
-            for match, handler in handlers:
-                if match(token):
-                    handler(token)
-                    break
+    def _collect_names(self, code, mode='eval', lineno=0):
+        """find names used by python code in tags and variables"""
+        try:
+            tree = ast.parse(code.strip(), mode=mode)
+        except SyntaxError as ex:
+            raise TemplateSyntaxError('{}:{}: {}: {!r}'.format(
+                self.name, lineno, ex.msg, code
+            )) from ex
+        if self.sandbox:
+            self._check_sandbox(tree, code, lineno)
+        if mode == 'exec':
+            # for ... in ...
+            target = tree.body[0].target
+            for node in ast.walk(target):
+                # not names used by targets like obj.attr or d[k]
+                if not (isinstance(node, ast.Name) and
+                        isinstance(node.ctx, ast.Store)):
+                    continue
+                if self._functions:
+                    # names assigned in {% cache %}, {% macro %} etc.
+                    # are local to their functions
+                    self._functions[-1]['locals'].add(node.id)
+                else:
+                    self.names_stored.add(node.id)
+        self._collect_loaded_names(tree)
+        return tree
+
+    def _collect_loaded_names(self, tree):
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load):
+                if not any(node.id in x['locals'] for x in self._functions):
+                    self.names_loaded.add(node.id)
+
+    def _check_sandbox(self, tree, code, lineno):
+        """reject private names, unsafe attributes and assignment to
+        attributes or items at compile time, e.g. ``{{ foo.__class__ }}``,
+        ``{{ '{0.__class__}'.format(foo) }}``,
+        ``{% for foo.is_admin in [True] %}``
+        """
+        for node in ast.walk(tree):
+            if (isinstance(node, (ast.Attribute, ast.Subscript)) and
+                    isinstance(node.ctx, (ast.Store, ast.Del))):
+                raise TemplateSyntaxError(
+                    '{}:{}: assignment to attributes and items is not '
+                    'allowed: {!r}'.format(self.name, lineno, code)
+                )
+            if isinstance(node, ast.Attribute):
+                name = node.attr
+                unsafe = name in self.SANDBOX_UNSAFE_ATTR
+            elif isinstance(node, ast.Name):
+                name = node.id
+                unsafe = False
+            elif isinstance(node, (ast.FunctionDef, ast.arg)):
+                # {% macro name(args) %}
+                name = getattr(node, 'name', None) or node.arg
+                unsafe = False
             else:
-                default_handler(token)
+                continue
+            if unsafe or name.startswith('_'):
+                raise TemplateSyntaxError(
+                    '{}:{}: access to {!r} is not allowed: {!r}'.format(
+                        self.name, lineno, name, code
+                    )
+                )
+
+    def _compile_text(self, node):
+        self._texts.append(node.value)
+        self.buffered_text.append(node.value)
+
+    def _compile_output(self, node):
+        self._is_static = False
+        self._collect_names(node.value, lineno=node.lineno)
+        self._handle_output(node.value)
+
+    def _handle_output(self, code):
+        if self.auto_escape:
+            self.buffer_code('escape({})'.format(code))
+        else:
+            self.buffer_code('to_text({})'.format(code))
 
+    def _compile_super(self, node):
+        # {{ block.super }} not in a block of child template
+        self._compile_output(Node('output', 'block.super', lineno=node.lineno))
+
+    def _compile_block(self, node):
+        timer = self._start_profile_timer()
+        self.compile_nodes(node.body)
+        if timer is not None:
+            self._end_profile_timer(timer, 'block {} ({})'.format(
+                node.value, self.name
+            ))
+
+    def _start_profile_timer(self):
+        # __profile_start_1 = __profile_timer()
+        if self.profiler is None:
+            return None
         self.flush_buffer()
-        self.code_builder.add_line('return "".join({})', self.result_var)
+        self._profile_timers += 1
+        timer = '__profile_start_{}'.format(self._profile_timers)
+        self.code_builder.add_line('{} = __profile_timer()', timer)
+        return timer
+
+    def _end_profile_timer(self, timer, name):
+        # __profile_record(name, __profile_timer() - __profile_start_1)
+        self.flush_buffer()
+        self.code_builder.add_line(
+            '__profile_record({!r}, __profile_timer() - {})', name, timer
+        )
+
+    def _compile_body(self, header, body):
+        # header:
+        #     body
+        self.flush_buffer()
+        self.code_builder.add_line(header)
+        self.code_builder.forward_indent()
+        start = len(self.code_builder.source_code)
+        self.compile_nodes(body)
+        self.flush_buffer()
+        if len(self.code_builder.source_code) == start:
+            self.code_builder.add_line('pass')
         self.code_builder.backward_indent()
 
-    def _handle_variable(self, token):
-        variable = self.strip_token(token, self.TOKEN_VARIABLE_START,
-                                    self.TOKEN_VARIABLE_END).strip()
-        if self.auto_escape:
-            self.buffered.append('escape({})'.format(variable))
+    def _compile_if(self, node):
+        self._is_static = False
+        for branch in node.body:
+            if branch.value is not None:
+                self._collect_names(branch.value, lineno=branch.lineno)
+        if all(x.tag == 'text' for branch in node.body for x in branch.body):
+            self._fold_branches(node.body)
+            return
+
+        for index, branch in enumerate(node.body):
+            if branch.value is None:
+                header = 'else:'
+            elif index == 0:
+                header = 'if {}:'.format(branch.value)
+            else:
+                header = 'elif {}:'.format(branch.value)
+            self._compile_body(header, branch.body)
+
+    def _fold_branches(self, branches):
+        """if statement only contains strings:
+
+        {% if a %}foo{% elif b %}bar{% endif %}
+
+        will be folded into an expression:
+
+        ('foo' if (a) else 'bar' if (b) else '')
+        """
+        expression = []
+        for branch in branches:
+            text = ''.join(x.value for x in branch.body)
+            if branch.value is None:
+                expression.append(repr(text))
+                break
+            expression.append(
+                '{} if ({}) else'.format(repr(text), branch.value)
+            )
         else:
-            self.buffered.append('to_text({})'.format(variable))
+            expression.append("''")
+        self.buffer_code('({})'.format(' '.join(expression)))
+
+    def _compile_for(self, node):
+        self._is_static = False
+        header = 'for {}:'.format(node.value)
+        self._collect_names(header + ' pass', mode='exec', lineno=node.lineno)
+        self._compile_body(header, node.body)
 
-    def _handle_comment(self, token):
-        pass
+    def _compile_async(self, node):
+        # {% async for x in lst %}...{% endfor %}
+        self._is_static = False
+        if not node.value.startswith('for ') or not self._is_async_scope():
+            raise TemplateSyntaxError('{}:{}: unexpected "async {}"'.format(
+                self.name, node.lineno, node.value
+            ))
+        header = 'async for {}:'.format(node.value[4:])
+        self._collect_names(header + ' pass', mode='exec', lineno=node.lineno)
+        self._compile_body(header, node.body)
 
-    def _handle_string(self, token):
-        self.buffered.append('{}'.format(repr(token)))
+    def _is_async_scope(self):
+        """whether generated code is in an ``async def`` function,
+        functions of {% macro %} and {% call %} are always synchronous
+        """
+        if self._functions:
+            return self._functions[-1]['is_async']
+        return self.enable_async
 
-    def _handle_tag(self, token):
+    def _compile_break(self, node):
+        self._is_static = False
+        self.flush_buffer()
+        self.code_builder.add_line('break')
+
+    def _compile_function(self, func_name, result_var, args, body,
+                          arg_names=(), return_code='{}', is_async=False,
+                          **kwargs):
+        # def func_name(args):
+        #     result_var = []
+        #     ...
+        #     return ''.join(result_var)
         self.flush_buffer()
-        tag = self.strip_token(token, self.TOKEN_TAG_START,
-                               self.TOKEN_TAG_END).strip()
-        tag_name = tag.split()[0]
-        if tag_name == 'include':
-            self._handle_include(tag)
+        source_code = self.code_builder.source_code
+        self.code_builder.add_line('{} {}({}):',
+                                   'async def' if is_async else 'def',
+                                   func_name, args)
+        self.code_builder.forward_indent()
+        # included templates used by the function are defined at its top,
+        # so they see its local variables
+        definitions = CodeBuilder(indent=self.code_builder.indent_level)
+        self._functions.append(dict(kwargs, locals=set(arg_names),
+                                    is_async=is_async,
+                                    definitions=definitions, includes=set()))
+        start = len(source_code)
+        self.code_builder.add_line('{} = []', result_var)
+        self.code_builder.add_line('_append = {}.append', result_var)
+        self.code_builder.add_line('_extend = {}.extend', result_var)
+        self.compile_nodes(body)
+        self.flush_buffer()
+        self._functions.pop()
+
+        if definitions.source_code:
+            source_code.insert(start + 3, definitions)
+            join_code = '"".join({})'.format(result_var)
+        elif len(source_code) == start + 3:
+            # empty function
+            del source_code[start:]
+            join_code = "''"
+        elif (len(source_code) == start + 4 and
+              self._last_flush[0] == start + 3):
+            # only one line of output, return it directly
+            del source_code[start:]
+            items = self._last_flush[1]
+            if len(items) == 1:
+                join_code = items[0]
+            else:
+                join_code = '"".join(({}))'.format(', '.join(items))
+        else:
+            join_code = '"".join({})'.format(result_var)
+        self.code_builder.add_line('return ' + return_code.format(join_code))
+        self.code_builder.backward_indent()
+
+    def _compile_cache(self, node):
+        # {% cache key ttl %}...{% endcache %}
+        # def __render_fragment():
+        #     __result_fragment = []
+        #     ...
+        #     return ''.join(__result_fragment)
+        # result.append(__cache_fragment(key, ttl, __render_fragment))
+        self._is_static = False
+        key, ttl = node.value, 'None'
+        parts = node.value.rsplit(None, 1)
+        if len(parts) == 2:
+            try:
+                for part in parts:
+                    compile(part, '<cache>', 'eval')
+            except SyntaxError:
+                pass
+            else:
+                key, ttl = parts
+        self._collect_names(key, lineno=node.lineno)
+        self._collect_names(ttl, lineno=node.lineno)
+
+        suffix = '_fragment_{}'.format(len(self._functions))
+        func_name = '__render' + suffix
+        is_async = self._is_async_scope()
+        self._compile_function(func_name, '__result' + suffix, '', node.body,
+                               is_async=is_async)
+        if is_async:
+            # (await __cache_fragment_async(key, ttl, __render_fragment))
+            self.buffer_code(
+                '(await __cache_fragment_async(({}), ({}), {}))'.format(
+                    key, ttl, func_name
+                )
+            )
         else:
-            self._handle_statement(tag, tag_name)
-
-    def _handle_statement(self, tag, tag_name):
-        if tag_name in ('if', 'elif', 'else', 'for'):
-            if tag_name in ('elif', 'else'):
-                self.code_builder.backward_indent()
-            self.code_builder.add_line('{}:'.format(tag))
-            self.code_builder.forward_indent()
-        elif tag_name in ('break',):
-            self.code_builder.add_line(tag)
-        elif tag_name in ('endif', 'endfor'):
-            self.code_builder.backward_indent()
-
-    def _handle_include(self, tag):
-        # parse included template file
+            self.buffer_code('__cache_fragment(({}), ({}), {})'.format(
+                key, ttl, func_name
+            ))
+
+    def _compile_macro(self, node):
+        # {% macro name(args) %}...{% endmacro %}
+        # defined at the top of current render function:
+        # def name(args, caller=None):
+        #     __result_macro_name = []
+        #     ...
+        #     return noescape(''.join(__result_macro_name))
+        self._is_static = False
+        signature = node.value
+        try:
+            tree = ast.parse('def {}: pass'.format(signature))
+            name = tree.body[0].name
+        except (SyntaxError, IndexError, AttributeError):
+            raise TemplateSyntaxError('{}:{}: invalid macro {!r}'.format(
+                self.name, node.lineno, signature
+            ))
+        if self.sandbox:
+            self._check_sandbox(tree, signature, node.lineno)
+        arguments = tree.body[0].args
+        args = signature[signature.index('(') + 1:signature.rindex(')')]
+        args = args.strip().rstrip(',')
+        arg_names = [x.arg for x in ast.walk(arguments)
+                     if isinstance(x, ast.arg)]
+        if 'caller' not in arg_names:
+            # {% call name(args) %}...{% endcall %} passes ``caller``
+            if arguments.kwarg is not None:
+                index = args.rindex('**')
+                args = args[:index] + 'caller=None, ' + args[index:]
+            elif args:
+                args += ', caller=None'
+            else:
+                args = 'caller=None'
+        # names used by default values
+        for default in arguments.defaults + arguments.kw_defaults:
+            if default is not None:
+                self._collect_loaded_names(default)
+        if not self._functions:
+            self.names_stored.add(name)
+
+        # macros are defined once, before other code of the function
+        code_builder = self.code_builder
+        buffered, buffered_text = self.buffered, self.buffered_text
+        self.code_builder = CodeBuilder(indent=self.definitions.indent_level)
+        self.definitions.add(self.code_builder)
+        self.buffered, self.buffered_text = [], []
+        self._compile_function(name, '__result_macro_' + name, args,
+                               node.body, arg_names=arg_names + ['caller'],
+                               return_code='noescape({})')
+        self.code_builder = code_builder
+        self.buffered, self.buffered_text = buffered, buffered_text
+
+    def _compile_call(self, node):
+        # {% call name(args) %}...{% endcall %}
+        # def __caller():
+        #     __result_caller = []
+        #     ...
+        #     return noescape(''.join(__result_caller))
+        # result.append(escape(name(args, caller=__caller)))
+        self._is_static = False
+        tree = self._collect_names(node.value, lineno=node.lineno)
+        if not isinstance(tree.body, ast.Call):
+            raise TemplateSyntaxError('{}:{}: invalid call {!r}'.format(
+                self.name, node.lineno, node.value
+            ))
+        suffix = '_caller_{}'.format(len(self._functions))
+        func_name = '__render' + suffix
+        code = node.value.strip()[:-1].rstrip()
+        if tree.body.args or tree.body.keywords:
+            code += ', '
+        code += 'caller={})'.format(func_name)
+        self._compile_function(func_name, '__result' + suffix, '', node.body,
+                               return_code='noescape({})')
+        self._handle_output(code)
+
+    def cache_fragment(self, key, ttl, render):
+        """return cached text of {% cache %} fragment,
+        call ``render()`` and cache the result if not found
+        """
+        text = self.fragment_cache.get(key)
+        if text is None:
+            text = render()
+            self.fragment_cache.set(key, text, ttl)
+        return text
+
+    async def cache_fragment_async(self, key, ttl, render):
+        """``cache_fragment`` for templates with ``enable_async``"""
+        text = self.fragment_cache.get(key)
+        if text is None:
+            text = await render()
+            self.fragment_cache.set(key, text, ttl)
+        return text
+
+    def _compile_include(self, node):
+        # parse included template file, every distinct file is defined
+        # only once by the outermost template (or by the {% cache %},
+        # {% macro %} or {% call %} function which includes it):
         # def func_name():    # current
         #     result = []
-        #     ...
         #     def func_name_inclued():   # included
         #         result_included = []
         #         ...
         #         return ''.join(result_included)
+        #     ...
         #     result.append(func_name_inclued())
         #     return ''.join(result)
-        path = ''.join(tag.split()[1:]).strip().strip('\'"')
-        _template = self._parse_another_template_file(path)
-        self.code_builder.add(_template.code_builder)
-        self.code_builder.add_line(
-            '{0}.append({1}())',
-            self.result_var, _template.func_name
+        scope = self._functions[-1] if self._functions else None
+        if scope is None:
+            indent = CodeBuilder.INDENT_STEP
+        else:
+            indent = scope['definitions'].indent_level
+        _template = self._parse_another_template_file(node.value, indent)
+        if _template.static_text is not None:
+            # static template, inline its text
+            self._texts.append(_template.static_text)
+            self.buffered_text.append(_template.static_text)
+            return
+
+        self._is_static = False
+        self.names_loaded.update(
+            name for name in _template.names_loaded
+            if not any(name in x['locals'] for x in self._functions)
         )
+        self.includes.update(_template.includes)
+        if scope is None:
+            self.includes[_template.func_name] = _template
+        elif _template.func_name not in scope['includes']:
+            scope['includes'].add(_template.func_name)
+            scope['definitions'].add(_template.code_builder)
+        if not self.enable_async:
+            self.buffer_code('{}()'.format(_template.func_name))
+        elif self._is_async_scope():
+            self.buffer_code('(await {}())'.format(_template.func_name))
+        else:
+            raise TemplateSyntaxError(
+                '{}:{}: can\'t include "{}" in macro of async '
+                'template'.format(self.name, node.lineno, node.value)
+            )
 
-    def _parse_another_template_file(self, path):
+    def _parse_another_template_file(self, path,
+                                     indent=CodeBuilder.INDENT_STEP):
         path = os.path.join(self.base_dir, path)
-        _hash = str(hash(path)).replace('-', '_').replace('.', '_')
-        func_name = self.func_name + _hash
-        result_var = self.result_var + _hash
+        # ``indent``: included templates are defined at the top of the
+        # outermost function or of the function which includes them
+        key = (os.path.abspath(path), self.auto_escape, indent, self.sandbox,
+               self.enable_async, self.profiler)
+        _template = self.template_cache.get(key)
+        if _template is not None:
+            return _template
+
+        suffix = '_include_{0}_{1:x}'.format(
+            re.sub(r'\W', '_', os.path.relpath(path, self.base_dir)),
+            zlib.crc32(key[0].encode('utf-8'))
+        )
+        func_name = '__render_function' + suffix
+        result_var = '__result' + suffix
 
         with open(path, encoding='utf-8') as f:
             _template = self.__class__(
                 f.read(), default_context=self.default_context,
-                pre_compile=False, indent=self.code_builder.indent_level,
+                pre_compile=False, indent=indent,
                 template_dir=self.base_dir,
                 auto_escape=self.auto_escape,
-                func_name=func_name, result_var=result_var
+                func_name=func_name, result_var=result_var,
+                template_cache=self.template_cache, nested=True,
+                name=os.path.relpath(path, self.base_dir),
+                sandbox=self.sandbox, enable_async=self.enable_async,
+                profiler=self.profiler
             )
-            return _template
+        self.template_cache.set(key, _template)
+        return _template
 
-    def handle_extends(self, text):
-        """replace all blocks in extends with current blocks"""
-        match = self.re_extends.match(text)
-        if match:
-            extra_text = self.re_extends.sub('', text, count=1)
-            blocks = self.get_blocks(extra_text)
-            path = os.path.join(self.base_dir, match.group('path'))
-            with open(path, encoding='utf-8') as fp:
-                return self.replace_blocks_in_extends(fp.read(), blocks)
-        else:
-            return None
-
-    def get_blocks(self, text):
-        return {
-            name: code
-            for (name, code) in self.re_block.findall(text)
-        }
-
-    def replace_blocks_in_extends(self, extends_text, blocks):
-        def replace(match):
-            name = match.group('name')
-            old_code = match.group('code')
-            code = blocks.get(name) or old_code
-            # {{ block.super }}
-            return self.re_block_super.sub(old_code, code)
-        return self.re_block.sub(replace, extends_text)
+    def compile(self):
+        """compile generated code once,
+        raise TemplateSyntaxError if the template is invalid
+        """
+        if self._code is not None:
+            return self._code
+        try:
+            self._code = self.code_builder._compile(self.name)
+        except SyntaxError as ex:
+            raise TemplateSyntaxError('{}: {}'.format(self.name, ex)) from ex
 
-    def render(self, **context):
-        self.code_builder._compile()
+        # define render function once, context will be passed as argument
         globals_dict = {
             '__builtins__': self.default_context,
         }
-        globals_dict.update(context)
+        for name in self.context_names:
+            globals_dict['__default_' + name] = self.default_context.get(
+                name, Undefined(name)
+            )
         namespace = self.code_builder._exec(globals_dict)
         self.render_function = namespace[self.func_name]
+        return self._code
 
-        html = self.render_function()
+    def render(self, **context):
+        if self.enable_async:
+            # run the async render function in a new event loop
+            return asyncio.run(self.render_async(**context))
+        if self.render_function is None:
+            self.compile()
+        html = self.render_function(context)
         return self.cleanup_extra_whitespaces(html)
 
+    async def render_async(self, **context):
+        """render template in an event loop,
+        expressions in the template can ``await`` values of the context.
+
+        Pass tasks (``asyncio.ensure_future(fetch())``) in ``context`` to
+        fetch data sources concurrently while rendering::
+
+            {{ await users }} {% async for x in items() %}...{% endfor %}
+        """
+        if not self.enable_async:
+            return self.render(**context)
+        if self.render_function is None:
+            self.compile()
+        html = await self.render_function(context)
+        return self.cleanup_extra_whitespaces(html)
+
+    def buffer_code(self, code):
+        """buffer a python expression"""
+        self._buffer_text()
+        self.buffered.append(code)
+
+    def _buffer_text(self):
+        # adjacent strings are merged into one constant
+        if self.buffered_text:
+            self.buffered.append(repr(''.join(self.buffered_text)))
+            self.buffered_text = []
+
     def flush_buffer(self):
         """flush all buffered string into code"""
-        self.code_builder.add_line('{0}.extend([{1}])',
-                                   self.result_var, ','.join(self.buffered))
+        self._buffer_text()
+        if not self.buffered:
+            return
+        self._last_flush = (len(self.code_builder.source_code), self.buffered)
+        if len(self.buffered) == 1:
+            self.code_builder.add_line('_append({})', self.buffered[0])
+        else:
+            self.code_builder.add_line('_extend(({}))',
+                                       ', '.join(self.buffered))
         self.buffered = []
 
     def strip_token(self, text, start, end):
@@ -325,6 +1163,9 @@ class NoEscapedText:
     def __init__(self, raw_text):
         self.raw_text = raw_text
 
+    def __str__(self):
+        return to_text(self.raw_text)
+
 
 html_escape_table = {
     '&': '&amp;',
@@ -333,14 +1174,32 @@ html_escape_table = {
     '>': '&gt;',
     '<': '&lt;',
 }
+# values whose text form never contains html special characters
+escape_safe_types = frozenset((int, float, bool))
 
 
 def html_escape(text):
-    return ''.join(html_escape_table.get(c, c) for c in text)
+    if not ('&' in text or '<' in text or '>' in text or
+            '"' in text or '\'' in text):
+        return text
+    # ``&`` must go first, otherwise the other entities get escaped twice
+    return (text.replace('&', '&amp;')
+                .replace('<', '&lt;')
+                .replace('>', '&gt;')
+                .replace('"', '&quot;')
+                .replace('\'', '&apos;'))
 
 
 def escape(text):
-    if isinstance(text, NoEscapedText):
+    _type = type(text)
+    if _type is str:
+        return html_escape(text)
+    elif _type is NoEscapedText and type(text.raw_text) is str:
+        # such as results of macros
+        return text.raw_text
+    elif _type in escape_safe_types:
+        return str(text)
+    elif isinstance(text, NoEscapedText):
         return to_text(text.raw_text)
     else:
         text = to_text(text)
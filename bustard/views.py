@@ -2,8 +2,9 @@
 import mimetypes
 import os
 
-from .exceptions import NotFound
+from .exceptions import HTTPException, NotFound
 from .http import Response
+from .wsgi_server import FileWrapper
 
 http_methods = ('get', 'post', 'head', 'options',
                 'delete', 'put', 'trace', 'patch')
@@ -53,8 +54,57 @@ class StaticFilesView(View):
         if not os.path.isfile(file_path):
             raise NotFound()
 
-        with open(file_path, 'rb') as fp:
-            content = fp.read()
         content_type = mimetypes.guess_type(file_path)[0]
         content_type = content_type or 'application/octet-stream'
-        return Response(content, content_type=content_type)
+        size = os.path.getsize(file_path)
+        headers = {'Accept-Ranges': 'bytes'}
+        status_code = 200
+        offset, length = 0, size
+        byte_range = self.get_range(request, size)
+        if byte_range is not None:
+            start, end = byte_range
+            offset, length = start, end - start + 1
+            status_code = 206
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+                start, end, size
+            )
+        headers['Content-Length'] = str(length)
+
+        fp = open(file_path, 'rb')
+        fp.seek(offset)
+        file_wrapper = request.environ.get('wsgi.file_wrapper')
+        if file_wrapper is FileWrapper:
+            # sent with os.sendfile by the server
+            content = FileWrapper(fp, length=length)
+        elif file_wrapper is not None and offset + length == size:
+            # wsgi.file_wrapper of other servers sends until end of file
+            content = file_wrapper(fp)
+        else:
+            with fp:
+                content = fp.read(length)
+        return Response(content, status_code=status_code,
+                        content_type=content_type, headers=headers)
+
+    def get_range(self, request, size):
+        """(first byte, last byte) of a single range ``Range`` header,
+        None for the whole file
+        """
+        value = request.headers.get('Range', '')
+        if not value.startswith('bytes=') or ',' in value:
+            return None
+        start, _, end = value[6:].strip().partition('-')
+        try:
+            if not start:
+                # last N bytes
+                start, end = max(size - int(end), 0), size - 1
+            else:
+                start = int(start)
+                end = min(int(end), size - 1) if end else size - 1
+        except ValueError:
+            return None
+        if start > end or start >= size:
+            response = Response(status_code=416, headers={
+                'Content-Range': 'bytes */{}'.format(size)
+            })
+            raise HTTPException(response)
+        return start, end
@@ -1,117 +1,676 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import asyncio
+import concurrent.futures
 import datetime
+import errno
+import http
 import io
+import os
+import queue
+import select
+import selectors
+import signal
 import socket
+import stat
 import sys
+import threading
 import time
-import urllib
+import traceback
+import urllib.parse
 
 from .utils import to_text, to_bytes
 
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+# adjacent buffers smaller than this are joined before a vectored write
+COALESCE_SIZE = 1024
+MSG_MORE = getattr(socket, 'MSG_MORE', 0)
 
-class WSGIServer:
-    address_family = socket.AF_INET
-    socket_type = socket.SOCK_STREAM
-    request_queue_size = 5
-    allow_reuse_address = True
-    default_request_version = 'HTTP/1.1'
-    server_version = 'WSGIServer/0.1'
-    weekdayname = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
-    monthname = [None,
-                 'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
-                 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
 
-    def __init__(self, server_address):
-        # 创建 socket
-        self.socket = socket.socket(self.address_family, self.socket_type)
-        # 绑定
-        self.server_bind(server_address)
-        # 监听
-        self.server_activate()
-        # 基本的 environ
-        self.setup_environ()
-        self.headers_set = []
+def coalesce_buffers(buffers, size=COALESCE_SIZE):
+    """join runs of adjacent buffers smaller than ``size``, larger
+    buffers are kept as they are to avoid copying them
+    """
+    result = []
+    small = []
+    for data in buffers:
+        if len(data) < size:
+            small.append(data)
+            continue
+        if small:
+            result.append(b''.join(small))
+            small = []
+        result.append(data)
+    if small:
+        result.append(b''.join(small))
+    return result
 
-    def server_bind(self, server_address):
-        if self.allow_reuse_address:
-            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-        self.socket.bind(server_address)
-        self.server_address = self.socket.getsockname()
+def sendmsg(sock, buffers, flags=0):
+    """send ``buffers`` (list of bytes) with one vectored write,
+    sent bytes are removed from ``buffers``.
 
-        host, port = self.socket.getsockname()[:2]
-        self.server_name = socket.getfqdn(host)
-        self.server_port = port
+    :return: number of bytes sent
+    """
+    if not buffers:
+        return 0
+    if hasattr(sock, 'sendmsg'):
+        sent = sock.sendmsg(buffers[:IOV_MAX], [], flags)
+    else:
+        sent = sock.send(buffers[0])
+    remain = sent
+    index = 0
+    while index < len(buffers) and len(buffers[index]) <= remain:
+        remain -= len(buffers[index])
+        index += 1
+    del buffers[:index]
+    if remain:
+        # partially sent buffer
+        buffers[0] = memoryview(buffers[0])[remain:]
+    return sent
 
-    def server_activate(self):
-        self.socket.listen(self.request_queue_size)
 
-    def setup_environ(self):
-        """https://www.python.org/dev/peps/pep-0333/#environ-variables"""
-        # Set up base environment
-        env = self.base_environ = {}
-        env['SERVER_NAME'] = self.server_name
-        env['GATEWAY_INTERFACE'] = 'CGI/1.1'
-        env['SERVER_PORT'] = str(self.server_port)
-        env['REMOTE_HOST'] = ''
-        env['CONTENT_LENGTH'] = ''
-        env['SCRIPT_NAME'] = ''
+class HTTPRequestError(Exception):
+    """invalid request, the server responds with ``status``"""
 
-    def get_app(self):
-        return self.application
+    def __init__(self, status, message=''):
+        super().__init__(status, message)
+        self.status = status
+        self.message = message
 
-    def set_app(self, application):
-        self.application = application
 
-    def serve_forever(self):
-        while 1:
-            self.handle_one_request()
-            self.client_connection.close()
+class HTTPRequest:
+    """a request parsed by HTTPRequestParser"""
+    __slots__ = ('method', 'path', 'version', 'headers', 'body')
 
-    def handle_one_request(self):
-        self.client_connection, self.client_address = self.socket.accept()
-        # self.raw_request = raw_request = self.client_connection.recv(65537)
-        init_read = 65536
-        self.raw_request = raw_request = self.client_connection.recv(init_read)
+    def __init__(self, method, path, version, headers, body=b''):
+        self.method = method
+        self.path = path
+        self.version = version
+        self.headers = headers
+        self.body = body
 
-        self.parse_request(raw_request)
-        self.parse_headers(raw_request)
-        length = int(self.headers.get('Content-Length', '0'))
-        while len(self.raw_request) == length:
-            self.raw_request += self.client_connection.recv(init_read)
+    @property
+    def keep_alive(self):
+        connection = self.headers.get('Connection', '').lower()
+        if self.version == 'HTTP/1.1':
+            return connection != 'close'
+        return connection == 'keep-alive'
+
+
+def parse_header_block(data):
+    """parse request line and headers:
+
+    b'GET /foo?a=1 HTTP/1.1\\r\\nHost: a\\r\\n' -> HTTPRequest
+    """
+    lines = to_text(bytes(data), 'latin-1').split('\r\n')
+    try:
+        method, path, version = lines[0].split()
+    except ValueError:
+        raise HTTPRequestError('400 Bad Request', 'invalid request line')
+    if not version.startswith('HTTP/1.'):
+        raise HTTPRequestError('505 HTTP Version Not Supported')
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        if ':' not in line:
+            raise HTTPRequestError('400 Bad Request', 'invalid header')
+        k, v = line.split(':', 1)
+        k = k.strip().title()
+        if headers.get(k):
+            headers[k] += ', ' + v.strip()  # 多个同名 header
+        else:
+            headers[k] = v.strip()
+    return HTTPRequest(method, path, version, headers)
+
+
+class HTTPRequestParser:
+    """incremental request parser, ``feed()`` bytes as they arrive and
+    get complete requests (headers and body) from ``next_request()``,
+    pipelined requests stay in the buffer.
+    """
+    max_header_size = 65536
+    # larger bodies read by next_request() are rejected with 413
+    max_body_size = 100 * 1024 * 1024
+
+    def __init__(self, max_header_size=None, max_body_size=None):
+        if max_header_size is not None:
+            self.max_header_size = max_header_size
+        if max_body_size is not None:
+            self.max_body_size = max_body_size
+        self.buffer = bytearray()
+        self._reset()
+
+    def _reset(self):
+        self.request = None
+        self.body = bytearray()
+        self.content_length = 0
+        self.chunked = False
+        self.chunk_size = None     # size of current chunk
+        self.trailers = False      # reading trailers of chunked body
+        # client waits for "100 Continue" before sending the body
+        self.expect_continue = False
+
+    def feed(self, data):
+        self.buffer += data
+
+    def next_headers(self):
+        """return request line and headers of next request or None,
+        the body is left in ``buffer``, see ``InputStream``;
+        ``content_length``, ``chunked`` and ``expect_continue`` are kept
+        until the headers of next request are parsed
+        """
+        if not self._parse_headers():
+            return None
+        request = self.request
+        self.request = None
+        return request
+
+    def next_request(self):
+        """return a complete request or None"""
+        if self.request is None and not self._parse_headers():
+            return None
+        if self.chunked:
+            done = self._parse_chunked()
+        else:
+            done = self._parse_body()
+        if not done:
+            return None
+        request = self.request
+        request.body = bytes(self.body)
+        self._reset()
+        return request
+
+    def _parse_headers(self):
+        # skip empty lines between requests
+        while self.buffer[:2] == b'\r\n':
+            del self.buffer[:2]
+        index = self.buffer.find(b'\r\n\r\n')
+        if index < 0:
+            if len(self.buffer) > self.max_header_size:
+                raise HTTPRequestError(
+                    '431 Request Header Fields Too Large'
+                )
+            return False
+        if index > self.max_header_size:
+            raise HTTPRequestError('431 Request Header Fields Too Large')
+        self.request = request = parse_header_block(self.buffer[:index])
+        del self.buffer[:index + 4]
+        self.expect_continue = (
+            request.headers.get('Expect', '').lower() == '100-continue'
+        )
+
+        self.chunked = False
+        self.content_length = 0
+        transfer_encoding = request.headers.get('Transfer-Encoding', '')
+        if transfer_encoding and 'Content-Length' in request.headers:
+            # ambiguous framing, e.g. request smuggling
+            raise HTTPRequestError('400 Bad Request',
+                                   'Content-Length with Transfer-Encoding')
+        if transfer_encoding.lower() == 'chunked':
+            self.chunked = True
+        elif transfer_encoding:
+            raise HTTPRequestError('501 Not Implemented',
+                                   'unsupported transfer encoding')
+        else:
+            try:
+                self.content_length = int(
+                    request.headers.get('Content-Length', '0')
+                )
+            except ValueError:
+                self.content_length = -1
+            if self.content_length < 0:
+                raise HTTPRequestError('400 Bad Request',
+                                       'invalid Content-Length')
+        return True
+
+    def _parse_body(self):
+        if self.content_length > self.max_body_size:
+            raise HTTPRequestError('413 Payload Too Large')
+        if len(self.buffer) < self.content_length:
+            return False
+        self.body = self.buffer[:self.content_length]
+        del self.buffer[:self.content_length]
+        return True
+
+    def _parse_chunked(self):
+        while True:
+            if self.trailers:
+                # trailers end with an empty line
+                index = self.buffer.find(b'\r\n')
+                if index < 0:
+                    return False
+                del self.buffer[:index + 2]
+                if index == 0:
+                    return True
+                continue
+            if self.chunk_size is None:
+                index = self.buffer.find(b'\r\n')
+                if index < 0:
+                    return False
+                size = self.buffer[:index].split(b';', 1)[0].strip()
+                try:
+                    self.chunk_size = int(size, 16)
+                except ValueError:
+                    raise HTTPRequestError('400 Bad Request',
+                                           'invalid chunk size')
+                del self.buffer[:index + 2]
+                if len(self.body) + self.chunk_size > self.max_body_size:
+                    raise HTTPRequestError('413 Payload Too Large')
+                if self.chunk_size == 0:
+                    self.trailers = True
+                continue
+            if len(self.buffer) < self.chunk_size + 2:
+                return False
+            self.body += self.buffer[:self.chunk_size]
+            del self.buffer[:self.chunk_size + 2]
+            self.chunk_size = None
+
+
+class InputStream:
+    """``wsgi.input`` of WSGIRequestHandler: body of a request is read
+    lazily from the connection, exactly ``Content-Length`` bytes or
+    decoded from chunked transfer encoding.
+
+    :param buffer: bytearray of bytes received but not parsed yet,
+                   bytes after the body are left in it
+    :param recv: function returns next bytes from the connection,
+                 ``b''`` if the connection is closed
+    :param on_read: called before the body is read, e.g. to send
+                    "100 Continue"
+    """
+
+    def __init__(self, buffer, recv, content_length=0, chunked=False,
+                 on_read=None):
+        self.buffer = buffer
+        self._recv = recv
+        self.chunked = chunked
+        # bytes left of the body or of current chunk
+        self.remaining = 0 if chunked else content_length
+        self.done = not chunked and not content_length
+        self._on_read = on_read
+
+    def _fill(self):
+        if self._on_read is not None:
+            self._on_read()
+            self._on_read = None
+        data = self._recv()
+        if not data:
+            raise ConnectionError('connection closed while reading body')
+        self.buffer += data
+
+    def _readline_raw(self):
+        # line of chunked encoding
+        while True:
+            index = self.buffer.find(b'\r\n')
+            if index >= 0:
+                line = bytes(self.buffer[:index])
+                del self.buffer[:index + 2]
+                return line
+            self._fill()
+
+    def _next_chunk(self):
+        size = self._readline_raw().split(b';', 1)[0].strip()
+        try:
+            self.remaining = int(size, 16)
+        except ValueError:
+            raise HTTPRequestError('400 Bad Request', 'invalid chunk size')
+        if not self.remaining:
+            # trailers
+            while self._readline_raw():
+                pass
+            self.done = True
+
+    def _available(self):
+        """number of body bytes which can be taken from buffer"""
+        if self.done:
+            return 0
+        if not self.remaining:
+            if self.chunked:
+                self._next_chunk()
+                return self._available()
+            self.done = True
+            return 0
+        if not self.buffer:
+            self._fill()
+        return min(len(self.buffer), self.remaining)
+
+    def _take(self, size):
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        self.remaining -= size
+        if self.chunked and not self.remaining:
+            # CRLF after chunk data
+            self._readline_raw()
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = sys.maxsize
+        chunks = []
+        while size > 0:
+            available = self._available()
+            if not available:
+                break
+            data = self._take(min(available, size))
+            size -= len(data)
+            chunks.append(data)
+        return b''.join(chunks)
+
+    def readline(self, size=-1):
+        if size is None or size < 0:
+            size = sys.maxsize
+        chunks = []
+        while size > 0:
+            available = self._available()
+            if not available:
+                break
+            index = self.buffer.find(b'\n', 0, min(available, size))
+            if index >= 0:
+                chunks.append(self._take(index + 1))
+                break
+            data = self._take(min(available, size))
+            size -= len(data)
+            chunks.append(data)
+        return b''.join(chunks)
+
+    def readlines(self, hint=-1):
+        lines = []
+        total = 0
+        for line in self:
+            lines.append(line)
+            total += len(line)
+            if 0 < hint <= total:
+                break
+        return lines
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def discard(self, max_size):
+        """read and discard the rest of the body,
+        return False if it's larger than ``max_size``
+        """
+        while not self.done:
+            if not self.chunked and self.remaining > max_size:
+                return False
+            data = self.read(min(max_size, 65536))
+            max_size -= len(data)
+            if max_size < 0:
+                return False
+        return True
+
+
+class FileWrapper:
+    """``wsgi.file_wrapper``: iterates over blocks of a file, the server
+    sends it with ``os.sendfile`` if the file has a file descriptor.
+
+    :param offset: position of the first byte to send, default is the
+                   current position of the file
+    :param length: number of bytes to send, default is until end of file
+    """
+
+    def __init__(self, filelike, blksize=8192, offset=None, length=None):
+        self.filelike = filelike
+        self.blksize = blksize
+        self.offset = offset
+        self.length = length
+        if hasattr(filelike, 'close'):
+            self.close = filelike.close
+
+    def fileno(self):
+        """file descriptor of the file or None"""
+        try:
+            return self.filelike.fileno()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            return None
+
+    def __iter__(self):
+        if self.offset is not None:
+            self.filelike.seek(self.offset)
+        remaining = self.length
+        while remaining is None or remaining > 0:
+            size = self.blksize
+            if remaining is not None:
+                size = min(size, remaining)
+                remaining -= size
+            data = self.filelike.read(size)
+            if not data:
+                return
+            yield data
 
-        env = self.get_environ()
 
-        print('[%s] "%s %s %s"' % (
-            datetime.datetime.now(), env['REQUEST_METHOD'],
-            env['PATH_INFO'], env['SERVER_PROTOCOL'],
-        ))
+class AccessLogger:
+    """access log written by a background thread: records of requests
+    wait in a bounded queue and are formatted and written in batches,
+    records are dropped (counted in ``dropped``) when the queue is full
+    instead of blocking requests.
 
-        result = self.application(env, self.start_response)
+    fields of ``format``: remote_addr, time, method, path, protocol,
+    status, bytes (sent, headers included), latency (milliseconds),
+    user_agent, referer
+    """
+    default_format = ('{remote_addr} - [{time}] "{method} {path} {protocol}" '
+                      '{status} {bytes} {latency:.2f}ms')
+
+    def __init__(self, stream=None, format=None, queue_size=10000,
+                 batch_size=256):
+        self.stream = stream
+        self.format = format or self.default_format
+        self.batch_size = batch_size
+        self.queue = queue.Queue(queue_size)
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def log(self, record):
+        """queue a record (dict of fields), never blocks"""
+        if self._thread is None:
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def start(self):
+        # started by the first record, so pre-fork workers start their own
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, daemon=True)
+                self._thread.start()
+
+    def close(self):
+        """write queued records and stop the thread"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self.queue.put(None)
+            thread.join()
+
+    def run(self):
+        while True:
+            records = [self.queue.get()]
+            while records[-1] is not None and len(records) < self.batch_size:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = [self.format_record(x) for x in records if x is not None]
+            if lines:
+                self.write(lines)
+            if records[-1] is None:
+                return
+
+    def format_record(self, record):
+        record['time'] = datetime.datetime.fromtimestamp(record['time'])
+        return self.format.format(**record)
+
+    def write(self, lines):
+        stream = self.stream or sys.stdout
+        try:
+            stream.write('\n'.join(lines) + '\n')
+            stream.flush()
+        except (OSError, ValueError):
+            pass
+
+
+class WSGIRequestHandler:
+    """handle requests of a client connection"""
+    # send body chunks as the app yields them, otherwise the body is
+    # joined and sent with Content-Length
+    stream_response = True
+
+    def __init__(self, server, connection, client_address):
+        self.server = server
+        self.client_connection = connection
+        self.client_address = client_address
+        self.headers_set = []
+        self.headers_sent = False
+        self.chunked = False    # chunked response body
+        self.bytes_sent = 0
+        self.parser = HTTPRequestParser(server.max_header_size,
+                                        server.max_body_size)
+        self.requests = 0   # number of requests handled
+        self.keep_alive = False
+
+    def handle(self):
+        """handle requests until the connection should be closed"""
+        self.client_connection.settimeout(self.server.timeout)
+        while True:
+            request = self.read_request()
+            if request is None:
+                return
+            self.requests += 1
+            rfile = self.make_input(request)
+            self.handle_request(
+                request, self.requests < self.server.max_keepalive_requests,
+                rfile=rfile
+            )
+            if self.keep_alive and not rfile.done:
+                # skip unread body before next request
+                self.keep_alive = self.discard_input(rfile)
+            if not self.keep_alive or self.server.draining:
+                return
+            # wait for next request
+            self.client_connection.settimeout(self.server.keepalive_timeout)
+
+    def read_request(self):
+        """read request line and headers of next request,
+        return None if the connection is closed or timed out
+        """
+        parser = self.parser
+        while True:
+            try:
+                request = parser.next_headers()
+            except HTTPRequestError as ex:
+                self.send(self.server.error_response(ex.status))
+                return None
+            if request is not None:
+                return request
+            data = self.recv()
+            if not data:
+                return None
+            if not parser.buffer:
+                # waited for next request with keepalive_timeout
+                self.client_connection.settimeout(self.server.timeout)
+            parser.feed(data)
+
+    def recv(self):
+        try:
+            return self.client_connection.recv(self.server.recv_size)
+        except (socket.timeout, ConnectionError):
+            return b''
+
+    def can_discard_input(self):
+        """whether unread body can be skipped to keep the connection"""
+        rfile = self.rfile
+        if not isinstance(rfile, InputStream) or rfile.done:
+            return True
+        if self.parser.expect_continue:
+            # the client waits for "100 Continue" to send the body
+            return False
+        return rfile.chunked or rfile.remaining <= self.server.max_discard_size
+
+    def discard_input(self, rfile):
+        try:
+            return rfile.discard(self.server.max_discard_size)
+        except (OSError, HTTPRequestError):
+            return False
+
+    def make_input(self, request):
+        # framing of the body is validated by the parser
+        parser = self.parser
+        return InputStream(
+            parser.buffer, self.recv, content_length=parser.content_length,
+            chunked=parser.chunked, on_read=self.send_continue
+        )
+
+    def send_continue(self):
+        # client waits for "100 Continue" before sending the body
+        if self.parser.expect_continue:
+            self.parser.expect_continue = False
+            self.send(b'HTTP/1.1 100 Continue\r\n\r\n')
+
+    def handle_request(self, request, keep_alive=True, rfile=None):
+        """call the app, ``keep_alive``: whether the connection can be
+        kept open after the response, ``rfile``: ``wsgi.input``, default
+        is ``request.body``
+        """
+        self.headers_set = []
+        self.headers_sent = False
+        self.chunked = False
+        self.bytes_sent = 0
+        self.request_method = request.method
+        self.path = request.path
+        self.request_version = request.version
+        self.headers = request.headers
+        if rfile is None:
+            if 'Transfer-Encoding' in request.headers:
+                # body is decoded already
+                del request.headers['Transfer-Encoding']
+                request.headers['Content-Length'] = str(len(request.body))
+            rfile = io.BytesIO(request.body)
+        self.rfile = rfile
+        self.keep_alive = (keep_alive and request.keep_alive and
+                           self.server.keepalive_timeout > 0)
+        self.run_application()
+
+    def run_application(self):
+        start_time = time.time()
+        start = time.perf_counter()
+        env = self.get_environ()
+        result = self.server.application(env, self.start_response)
         self.finish_response(result)
+        if self.server.access_logger:
+            self.log_request(start_time, time.perf_counter() - start)
 
-    def parse_request(self, raw_request):
-        # GET /foo?a=1&b=2 HTTP/1.1
-        first_line = to_text(raw_request.split(b'\r\n', 1)[0].strip())
-        (self.request_method,   # GET
-         self.path,             # /foo?a=1&b=2
-         self.request_version   # HTTP/1.1
-         ) = first_line.split()
-
-    def parse_headers(self, raw_request):
-        header_string = to_text(raw_request.split(b'\r\n\r\n', 1)[0])
-        self.headers = headers = {}
-        for header in header_string.splitlines()[1:]:
-            k, v = header.split(':', 1)
-            if headers.get(k):
-                headers[k] += ', ' + v.strip()  # 多个同名 header
-            else:
-                headers[k] = v.strip()
+    def log_request(self, start_time, latency):
+        headers = self.headers
+        self.server.access_logger.log({
+            'remote_addr': self.client_address[0],
+            'time': start_time,
+            'method': self.request_method,
+            'path': self.path,
+            'protocol': self.request_version,
+            'status': self.headers_set[0].split(' ', 1)[0],
+            'bytes': self.bytes_sent,
+            'latency': latency * 1000,
+            'user_agent': headers.get('User-Agent', '-'),
+            'referer': headers.get('Referer', '-'),
+        })
 
     def get_environ(self):
         """https://www.python.org/dev/peps/pep-0333/#environ-variables"""
-        env = self.base_environ.copy()
+        env = self.server.base_environ.copy()
         env['REQUEST_METHOD'] = self.request_method
 
         if '?' in self.path:
@@ -122,7 +681,11 @@ class WSGIServer:
         env['QUERY_STRING'] = query
 
         env['CONTENT_TYPE'] = self.headers.get('Content-Type', '')
-        env['CONTENT_LENGTH'] = self.headers.get('Content-Length', '0')
+        if 'Transfer-Encoding' in self.headers:
+            # chunked body, length is unknown
+            env['CONTENT_LENGTH'] = ''
+        else:
+            env['CONTENT_LENGTH'] = self.headers.get('Content-Length', '0')
 
         env['SERVER_PROTOCOL'] = self.request_version
         env['REMOTE_ADDR'] = self.client_address[0]
@@ -130,11 +693,14 @@ class WSGIServer:
 
         env['wsgi.version'] = (1, 0)
         env['wsgi.url_scheme'] = 'http'
-        env['wsgi.input'] = io.BytesIO(self.raw_request)
+        env['wsgi.input'] = self.rfile
         env['wsgi.errors'] = sys.stderr
-        env['wsgi.multithread'] = False
-        env['wsgi.multiprocess'] = True
+        env['wsgi.multithread'] = self.server.multithread
+        env['wsgi.multiprocess'] = self.server.multiprocess
         env['wsgi.run_once'] = False
+        # wsgi.input returns b'' at the end of body
+        env['wsgi.input_terminated'] = True
+        env['wsgi.file_wrapper'] = FileWrapper
 
         for k, v in self.headers.items():
             k = k.replace('-', '_').upper()
@@ -144,45 +710,419 @@ class WSGIServer:
         return env
 
     def start_response(self, status, headers, exc_info=None):
-        server_headers = [
-            ('Date', self.date_time_string()),
-            ('Server', self.version_string()),
-        ]
-        headers = list(headers) + server_headers
+        headers = list(headers)
 
         if exc_info:
             try:
-                if self.headers_set:
+                if self.headers_sent:
                     # Re-raise original exception if headers sent
-                    raise (exc_info[0], exc_info[1], exc_info[2])
+                    raise exc_info[1].with_traceback(exc_info[2])
             finally:
                 exc_info = None     # avoid dangling circular ref
+        elif self.headers_set:
+            raise AssertionError('headers already set')
 
         self.headers_set[:] = [status, headers]
+        return self.write
+
+    def finish_response(self, result):
+        try:
+            if isinstance(result, FileWrapper) and self.send_file(result):
+                return
+            if isinstance(result, (list, tuple)):
+                chunks = result
+            elif not self.stream_response:
+                chunks = list(result)
+            else:
+                chunks = None
+            if chunks is not None:
+                # the whole body is known, frame it with Content-Length
+                # and send it with one vectored write
+                self.set_content_length(sum(map(len, chunks)))
+                self.write_chunks(chunks, end=True)
+                return
+            for data in result:
+                if data:
+                    self.write(data)
+            self.write_chunks([], end=True)
+        finally:
+            # PEP 3333
+            if hasattr(result, 'close'):
+                result.close()
+
+    def send_file(self, wrapper):
+        """send ``wsgi.file_wrapper`` with ``socket.sendfile`` (zero-copy
+        ``os.sendfile``), return False if it isn't possible
+        """
+        fileno = wrapper.fileno()
+        if fileno is None or self.headers_sent or not self.stream_response:
+            return False
+        try:
+            st = os.fstat(fileno)
+            offset = wrapper.offset
+            if offset is None:
+                offset = wrapper.filelike.tell()
+        except (OSError, io.UnsupportedOperation):
+            return False
+        if not stat.S_ISREG(st.st_mode):
+            return False
+        length = max(st.st_size - offset, 0)
+        if wrapper.length is not None:
+            length = min(length, wrapper.length)
+        self.set_content_length(length)
+        headers = self.make_headers()
+        if self.request_method == 'HEAD' or not length or (
+                self.headers_set[0].startswith(('1', '204', '304'))):
+            self.send_buffers([headers])
+            return True
+        # MSG_MORE: headers and the start of file are sent in one packet
+        buffers = [headers]
+        while buffers:
+            sendmsg(self.client_connection, buffers, MSG_MORE)
+        self.bytes_sent += len(headers)
+        sent = self.client_connection.sendfile(wrapper.filelike,
+                                               offset, length)
+        self.bytes_sent += sent
+        if sent < length:
+            # file was truncated, Content-Length is wrong
+            self.keep_alive = False
+        return True
+
+    def set_content_length(self, length):
+        status, headers = self.headers_set
+        if self.headers_sent or status.startswith(('1', '204', '304')):
+            return
+        for name, _ in headers:
+            if name.lower() == 'content-length':
+                return
+        headers.append(('Content-Length', str(length)))
+
+    def make_headers(self):
+        """status line and headers, the body is framed with
+        ``Content-Length``, chunked encoding or closing the connection
+        """
+        status, headers = self.headers_set
+        names = {k.lower(): v for k, v in headers}
+        if names.get('connection', '').lower() == 'close' or (
+                self.server.draining or not self.can_discard_input()):
+            self.keep_alive = False
+        if 'content-length' not in names and not status.startswith(
+                ('1', '204', '304')) and self.request_method != 'HEAD':
+            if self.request_version == 'HTTP/1.1':
+                headers.append(('Transfer-Encoding', 'chunked'))
+                self.chunked = True
+            else:
+                # the end of body is marked by closing the connection
+                self.keep_alive = False
+        if not self.keep_alive:
+            headers.append(('Connection', 'close'))
+        elif self.request_version == 'HTTP/1.0':
+            headers.append(('Connection', 'keep-alive'))
+        self.headers_sent = True
+        # Date and Server headers are encoded by the server
+        return b''.join([
+            self.server.status_line_prefix, to_bytes(status), b'\r\n',
+            self.server.server_headers(),
+            to_bytes(''.join(['%s: %s\r\n' % x for x in headers])),
+            b'\r\n',
+        ])
+
+    def write(self, data):
+        """send a chunk of body, headers are sent before the first one"""
+        if not self.headers_set:
+            raise AssertionError('write() before start_response()')
+        self.write_chunks([data])
+
+    def write_chunks(self, chunks, end=False):
+        """send headers (if not sent yet) and chunks of body with one
+        vectored write, ``end``: the body is finished
+        """
+        buffers = [] if self.headers_sent else [self.make_headers()]
+        if self.request_method == 'HEAD':
+            pass
+        elif self.chunked:
+            for data in chunks:
+                if data:
+                    buffers.extend((b'%x\r\n' % len(data), data, b'\r\n'))
+            if end:
+                buffers.append(b'0\r\n\r\n')
+        else:
+            buffers.extend(chunks)
+        if buffers:
+            self.send_buffers(coalesce_buffers(buffers))
+
+    def send(self, data):
+        self.client_connection.sendall(data)
+        self.bytes_sent += len(data)
+
+    def send_buffers(self, buffers):
+        while buffers:
+            self.bytes_sent += sendmsg(self.client_connection, buffers)
+
+
+class WSGIServer:
+    address_family = socket.AF_INET
+    socket_type = socket.SOCK_STREAM
+    # listen backlog
+    request_queue_size = 5
+    allow_reuse_address = True
+    default_request_version = 'HTTP/1.1'
+    server_version = 'WSGIServer/0.1'
+    handler_class = WSGIRequestHandler
+    # wsgi.multithread, wsgi.multiprocess
+    multithread = False
+    multiprocess = False
+    recv_size = 65536
+    # seconds to wait for the next request of a connection,
+    # 0 disables keep-alive: an idle connection would block the
+    # single threaded server
+    keepalive_timeout = 0
+    # close connection after this number of requests
+    max_keepalive_requests = 100
+    # seconds a connection can make no progress when reading a request
+    # or writing a response
+    timeout = 60
+    # new connections are rejected with 503 when this number of
+    # connections are open, None for no limit
+    max_connections = None
+    # larger request line and headers are rejected with 431
+    max_header_size = HTTPRequestParser.max_header_size
+    # larger request bodies buffered by SelectorWSGIServer and
+    # AsyncioWSGIServer are rejected with 413
+    max_body_size = HTTPRequestParser.max_body_size
+    # close instead of reading larger unread request bodies
+    max_discard_size = 1024 * 1024
+    # seconds to finish requests in progress after shutdown()
+    graceful_timeout = 30
+    weekdayname = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+    monthname = [None,
+                 'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+    def __init__(self, server_address, reuse_port=False,
+                 keepalive_timeout=None, max_keepalive_requests=None,
+                 access_logger=None, backlog=None, timeout=None,
+                 max_connections=None, max_header_size=None,
+                 max_body_size=None, fd=None):
+        """``access_logger``: ``AccessLogger``, the default one writes to
+        stdout, False disables the access log; ``backlog``, ``timeout``,
+        ``max_connections``, ``max_header_size`` and ``max_body_size``
+        override the class attributes; ``fd``: file descriptor of a bound
+        socket to use instead of binding ``server_address``, e.g.
+        inherited from the process which re-executed this one
+        """
+        self.reuse_port = reuse_port
+        if access_logger is None:
+            access_logger = AccessLogger()
+        self.access_logger = access_logger
+        if backlog is not None:
+            self.request_queue_size = backlog
+        if timeout is not None:
+            self.timeout = timeout
+        if max_connections is not None:
+            self.max_connections = max_connections
+        if max_header_size is not None:
+            self.max_header_size = max_header_size
+        if max_body_size is not None:
+            self.max_body_size = max_body_size
+        # open connections of the blocking servers
+        self.active_connections = set()
+        self._connections_lock = threading.Lock()
+        if keepalive_timeout is not None:
+            self.keepalive_timeout = keepalive_timeout
+        if max_keepalive_requests is not None:
+            self.max_keepalive_requests = max_keepalive_requests
+        if fd is not None:
+            self.socket = socket.socket(fileno=fd)
+            self.server_address = self.socket.getsockname()
+            host, port = self.server_address[:2]
+            self.server_name = socket.getfqdn(host)
+            self.server_port = port
+        else:
+            # 创建 socket
+            self.socket = socket.socket(self.address_family,
+                                        self.socket_type)
+            # 绑定
+            self.server_bind(server_address)
+        # 监听
+        self.server_activate()
+        # 基本的 environ
+        self.setup_environ()
+        # (second, encoded Date and Server headers)
+        self._server_headers = (None, b'')
+        self.status_line_prefix = to_bytes(
+            self.default_request_version + ' '
+        )
+        self._shutdown_request = False
+        self._is_shut_down = threading.Event()
+        # set by shutdown(): responses close the connection
+        self.draining = False
+
+    def server_bind(self, server_address):
+        if self.allow_reuse_address:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            # every process binds its own socket, kernel balances connections
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        self.socket.bind(server_address)
+        self.server_address = self.socket.getsockname()
+
+        host, port = self.socket.getsockname()[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+
+    def server_activate(self):
+        self.socket.listen(self.request_queue_size)
+
+    def setup_environ(self):
+        """https://www.python.org/dev/peps/pep-0333/#environ-variables"""
+        # Set up base environment
+        env = self.base_environ = {}
+        env['SERVER_NAME'] = self.server_name
+        env['GATEWAY_INTERFACE'] = 'CGI/1.1'
+        env['SERVER_PORT'] = str(self.server_port)
+        env['REMOTE_HOST'] = ''
+        env['CONTENT_LENGTH'] = ''
+        env['SCRIPT_NAME'] = ''
+
+    def get_app(self):
+        return self.application
+
+    def set_app(self, application):
+        self.application = application
 
-    def finish_response(self, body):
+    def serve_forever(self, poll_interval=0.5):
+        """handle requests until ``shutdown()``"""
+        self._is_shut_down.clear()
+        self.draining = False
         try:
-            status, headers = self.headers_set
-            # status line
-            response = (
-                to_bytes(self.default_request_version) +
-                b' ' +
-                to_bytes(status) +
-                b'\r\n'
+            with selectors.DefaultSelector() as selector:
+                selector.register(self.socket, selectors.EVENT_READ)
+                while not self._shutdown_request:
+                    if selector.select(poll_interval):
+                        self.handle_one_request()
+        finally:
+            self._shutdown_request = False
+            self._is_shut_down.set()
+
+    def shutdown(self, wait=True):
+        """stop accepting connections, finish requests in progress and
+        close keep-alive connections, wait until ``serve_forever`` returns;
+        ``wait=False`` for signal handlers of the serving thread
+        """
+        self.draining = True
+        self._shutdown_request = True
+        if wait:
+            self._is_shut_down.wait()
+
+    def server_close(self):
+        self.socket.close()
+        if self.access_logger:
+            self.access_logger.close()
+
+    def handle_one_request(self):
+        try:
+            connection, client_address = self.socket.accept()
+        except OSError:
+            return
+        with self._connections_lock:
+            overloaded = (
+                self.max_connections is not None and
+                len(self.active_connections) >= self.max_connections
             )
-            # headers
-            response += b'\r\n'.join([to_bytes(': '.join(x)) for x in headers])
-            response += b'\r\n\r\n'
-            # body
-            for d in body:
-                response += d
-            self.client_connection.sendall(response)
+            if not overloaded:
+                self.active_connections.add(connection)
+        if overloaded:
+            self.reject_request(connection)
+            return
+        self.process_request(connection, client_address)
+
+    def reject_request(self, connection):
+        """respond 503 to a connection when the server is overloaded,
+        without blocking
+        """
+        connection.setblocking(False)
+        try:
+            # unread request makes close() reset the connection
+            connection.recv(self.recv_size)
+        except OSError:
+            pass
+        try:
+            connection.send(self.error_response('503 Service Unavailable'))
+        except OSError:
+            pass
+        connection.close()
+
+    def process_request(self, connection, client_address):
+        handler = self.handler_class(self, connection, client_address)
+        try:
+            handler.handle()
+        except Exception:
+            self.handle_error(client_address)
+            if not handler.headers_sent:
+                try:
+                    connection.sendall(
+                        self.error_response('500 Internal Server Error')
+                    )
+                except OSError:
+                    pass
         finally:
-            self.client_connection.close()
+            self.close_request(connection)
+            with self._connections_lock:
+                self.active_connections.discard(connection)
+
+    def close_connections(self):
+        """shut down open connections, requests in progress fail instead
+        of blocking shutdown, e.g. after ``graceful_timeout``
+        """
+        with self._connections_lock:
+            connections = list(self.active_connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def close_request(self, connection):
+        try:
+            connection.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        connection.close()
+
+    def error_response(self, status):
+        """response of invalid requests"""
+        body = to_bytes(status)
+        return (
+            b'HTTP/1.1 ' + body + b'\r\n'
+            b'Content-Type: text/plain\r\n'
+            b'Content-Length: ' + to_bytes(str(len(body))) + b'\r\n'
+            b'Connection: close\r\n\r\n' + body
+        )
+
+    def handle_error(self, client_address):
+        print('Exception happened during processing of request from',
+              client_address, file=sys.stderr)
+        traceback.print_exc()
 
     def version_string(self):
         return self.server_version
 
+    def server_headers(self):
+        """encoded Date and Server headers of responses,
+        the date is formatted at most once per second
+        """
+        now = int(time.time())
+        cached = self._server_headers
+        if cached[0] != now:
+            cached = self._server_headers = (now, to_bytes(
+                'Date: {}\r\nServer: {}\r\n'.format(
+                    self.date_time_string(now), self.version_string()
+                )
+            ))
+        return cached[1]
+
     def date_time_string(self, timestamp=None):
         if timestamp is None:
             timestamp = time.time()
@@ -195,22 +1135,961 @@ class WSGIServer:
         return s
 
 
-def make_server(server_address, application):
-    server = WSGIServer(server_address)
-    server.set_app(application)
-    return server
+class ThreadPoolWSGIServer(WSGIServer):
+    """handle requests in a fixed pool of worker threads,
+    accepted connections wait in a bounded queue when all workers are busy
+    """
+    multithread = True
+    # don't drop connections while workers are busy
+    request_queue_size = 128
+    keepalive_timeout = 5
+
+    def __init__(self, server_address, threads=10, queue_size=None,
+                 **kwargs):
+        self.threads = threads
+        if queue_size is None:
+            queue_size = threads * 4
+        self.requests = queue.Queue(queue_size)
+        self.workers = []
+        super().__init__(server_address, **kwargs)
+        if self.max_connections is None:
+            # when all workers are busy and the queue is full, new
+            # connections get 503 instead of waiting in the listen backlog
+            self.max_connections = threads + queue_size
+
+    def serve_forever(self, poll_interval=0.5):
+        self.start_workers()
+        try:
+            super().serve_forever(poll_interval)
+        finally:
+            self.stop_workers()
+
+    def start_workers(self):
+        for i in range(self.threads):
+            worker = threading.Thread(
+                target=self.process_requests,
+                name='{}-{}'.format(self.__class__.__name__, i),
+                daemon=True
+            )
+            worker.start()
+            self.workers.append(worker)
+
+    def stop_workers(self):
+        """finish queued connections and requests in progress, the
+        connections still open after ``graceful_timeout`` are closed
+        """
+        for _ in self.workers:
+            self.requests.put(None)
+        deadline = time.monotonic() + self.graceful_timeout
+        for worker in self.workers:
+            worker.join(max(deadline - time.monotonic(), 0))
+        if any(worker.is_alive() for worker in self.workers):
+            self.close_connections()
+            for worker in self.workers:
+                worker.join(1)
+        self.workers = []
+
+    def process_request(self, connection, client_address):
+        self.requests.put((connection, client_address))
+
+    def process_requests(self):
+        """worker thread: handle connections from the queue"""
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+            super().process_request(*request)
 
 
-if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        sys.exit('Provide a WSGI application object as module:callable')
-    app_path = sys.argv[1]
-    module, application = app_path.split(':')
-    module = __import__(module)
-    application = getattr(module, application)
+class BufferedRequestHandler(WSGIRequestHandler):
+    """handle a request read by SelectorWSGIServer,
+    the response is buffered in ``output``
+    """
+    stream_response = False
+
+    def handle_request(self, request, keep_alive=True):
+        self.output = []
+        super().handle_request(request, keep_alive)
+
+    def send(self, data):
+        self.output.append(data)
+        self.bytes_sent += len(data)
+
+    def send_buffers(self, buffers):
+        self.output.extend(buffers)
+        self.bytes_sent += sum(map(len, buffers))
+
+
+class Connection:
+    """client connection of SelectorWSGIServer"""
+    __slots__ = ('sock', 'address', 'parser', 'output', 'busy', 'closing',
+                 'closed', 'requests', 'last_active')
+
+    def __init__(self, sock, address, max_header_size=None,
+                 max_body_size=None):
+        self.sock = sock
+        self.address = address
+        self.parser = HTTPRequestParser(max_header_size, max_body_size)
+        self.output = []       # buffers to send
+        self.busy = False      # a request is being handled
+        self.closing = False   # close after output is sent
+        self.closed = False
+        self.requests = 0
+        self.last_active = time.monotonic()
+
+
+class SelectorWSGIServer(WSGIServer):
+    """non-blocking server, one thread multiplexes all connections with
+    ``selectors``: requests are parsed incrementally as bytes arrive and
+    the app is called when a request is fully read, so idle and slow
+    clients don't block other connections.
+
+    the app is called in the event loop thread, or in a pool of
+    ``threads`` threads.
+    """
+    handler_class = BufferedRequestHandler
+    request_queue_size = 1024
+    keepalive_timeout = 5
+
+    def __init__(self, server_address, threads=None, **kwargs):
+        self.threads = threads
+        self.multithread = bool(threads)
+        self.connections = {}
+        super().__init__(server_address, **kwargs)
+
+    def serve_forever(self, poll_interval=0.5):
+        self._is_shut_down.clear()
+        self.draining = False
+        self.socket.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ)
+        self.executor = None
+        if self.threads:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                self.threads
+            )
+            # responses of worker threads, the event loop is woken up by
+            # writing to _wakeup_w
+            self._responses = queue.SimpleQueue()
+            self._wakeup_r, self._wakeup_w = socket.socketpair()
+            self._wakeup_r.setblocking(False)
+            self.selector.register(self._wakeup_r, selectors.EVENT_READ)
+        try:
+            while not self._shutdown_request:
+                self.handle_events(poll_interval)
+            # stop accepting, finish requests in progress
+            self.selector.unregister(self.socket)
+            deadline = time.monotonic() + self.graceful_timeout
+            while self.connections and time.monotonic() < deadline:
+                self.handle_events(min(poll_interval, 0.05))
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.selector.unregister(self._wakeup_r)
+                self._wakeup_r.close()
+                self._wakeup_w.close()
+            for connection in list(self.connections.values()):
+                self.close_connection(connection)
+            if self.socket in self.selector.get_map():
+                self.selector.unregister(self.socket)
+            self.selector.close()
+            self._shutdown_request = False
+            self._is_shut_down.set()
+
+    def handle_events(self, timeout):
+        for key, events in self.selector.select(timeout):
+            if key.fileobj is self.socket:
+                self.accept_connections()
+            elif key.data is None:
+                self.handle_responses()
+            else:
+                self.handle_event(key.data, events)
+        self.service_actions()
+
+    def service_actions(self):
+        """called in every iteration of the event loop"""
+        self.close_idle_connections()
+
+    def close_idle_connections(self):
+        now = time.monotonic()
+        for connection in list(self.connections.values()):
+            if connection.busy:
+                continue
+            parser = connection.parser
+            idle = (not connection.output and parser.request is None and
+                    not parser.buffer)
+            if connection.requests and idle and self.draining:
+                self.close_connection(connection)
+                continue
+            if connection.requests and idle:
+                # waiting for next request
+                timeout = self.keepalive_timeout
+            else:
+                timeout = self.timeout
+            if now - connection.last_active > timeout:
+                self.close_connection(connection)
+
+    def accept_connections(self):
+        while True:
+            try:
+                sock, address = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                # e.g. EMFILE, try again in next iteration
+                return
+            if (self.max_connections is not None and
+                    len(self.connections) >= self.max_connections):
+                self.reject_request(sock)
+                continue
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = Connection(sock, address, self.max_header_size,
+                                    self.max_body_size)
+            self.connections[sock.fileno()] = connection
+            self.selector.register(sock, selectors.EVENT_READ, connection)
+
+    def handle_event(self, connection, events):
+        if events & selectors.EVENT_READ:
+            self.read(connection)
+        if events & selectors.EVENT_WRITE and not connection.closed:
+            self.write(connection)
+            # pipelined requests
+            self.process_requests(connection)
+
+    def read(self, connection):
+        try:
+            data = connection.sock.recv(self.recv_size)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.close_connection(connection)
+            return
+        connection.last_active = time.monotonic()
+        connection.parser.feed(data)
+        self.process_requests(connection)
+
+    def process_requests(self, connection):
+        # one request of a connection at a time, the responses of
+        # pipelined requests are sent in order
+        while not (connection.busy or connection.closing or
+                   connection.output or connection.closed):
+            try:
+                request = connection.parser.next_request()
+            except HTTPRequestError as ex:
+                self.send_error(connection, ex.status)
+                return
+            if request is None:
+                if connection.parser.expect_continue:
+                    connection.parser.expect_continue = False
+                    connection.output.append(
+                        b'HTTP/1.1 100 Continue\r\n\r\n'
+                    )
+                    self.write(connection)
+                return
+            connection.busy = True
+            connection.requests += 1
+            if self.executor is None:
+                self.finish_request(connection,
+                                    *self.handle_request(connection, request))
+            else:
+                self.executor.submit(self.handle_request_in_thread,
+                                     connection, request)
+
+    def handle_request(self, connection, request):
+        """call the app, return (response buffers, keep alive)"""
+        handler = self.handler_class(self, connection.sock,
+                                     connection.address)
+        keep_alive = connection.requests < self.max_keepalive_requests
+        try:
+            handler.handle_request(request, keep_alive)
+        except Exception:
+            self.handle_error(connection.address)
+            return [self.error_response('500 Internal Server Error')], False
+        return handler.output, handler.keep_alive
+
+    def handle_request_in_thread(self, connection, request):
+        self._responses.put(
+            (connection,) + self.handle_request(connection, request)
+        )
+        self._wakeup_w.send(b'\0')
+
+    def handle_responses(self):
+        try:
+            while self._wakeup_r.recv(1024):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        while not self._responses.empty():
+            connection, buffers, keep_alive = self._responses.get()
+            self.finish_request(connection, buffers, keep_alive)
+            # pipelined requests
+            self.process_requests(connection)
+
+    def finish_request(self, connection, buffers, keep_alive):
+        connection.busy = False
+        if connection.closed:
+            return
+        connection.last_active = time.monotonic()
+        connection.output.extend(buffers)
+        connection.closing = not keep_alive
+        self.write(connection)
+
+    def send_error(self, connection, status):
+        connection.output.append(self.error_response(status))
+        connection.closing = True
+        self.write(connection)
+
+    def write(self, connection):
+        try:
+            sent = sendmsg(connection.sock, connection.output)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self.close_connection(connection)
+            return
+        if sent:
+            connection.last_active = time.monotonic()
+        if connection.output:
+            self.selector.modify(
+                connection.sock,
+                selectors.EVENT_READ | selectors.EVENT_WRITE, connection
+            )
+            return
+        self.selector.modify(connection.sock, selectors.EVENT_READ,
+                             connection)
+        if connection.closing:
+            self.close_connection(connection)
+
+    def close_connection(self, connection):
+        if connection.closed:
+            return
+        connection.closed = True
+        self.connections.pop(connection.sock.fileno(), None)
+        self.selector.unregister(connection.sock)
+        self.close_request(connection.sock)
 
-    SERVER_ADDRESS = (HOST, PORT) = '', 8888
-    httpd = make_server(SERVER_ADDRESS, application)
-    print('WSGIServer: Serving HTTP on port {port} ...\n'.format(port=PORT))
 
-    httpd.serve_forever()
+class AsyncioWSGIServer(WSGIServer):
+    """asyncio server (uvloop if it's installed): connections are handled
+    by coroutines, so idle and slow clients don't tie up threads. WSGI
+    apps are called in a pool of ``threads`` threads, ASGI apps
+    (``async def app(scope, receive, send)``) run in the event loop.
+
+    :param interface: ``'wsgi'`` or ``'asgi'``, detected by default
+    """
+    handler_class = BufferedRequestHandler
+    multithread = True
+    request_queue_size = 1024
+    keepalive_timeout = 5
+
+    def __init__(self, server_address, threads=10, interface=None,
+                 **kwargs):
+        self.threads = threads
+        self.interface = interface
+        # connection task -> whether a request is in progress
+        self.connections = {}
+        super().__init__(server_address, **kwargs)
+
+    def new_event_loop(self):
+        try:
+            import uvloop
+        except ImportError:
+            return asyncio.new_event_loop()
+        return uvloop.new_event_loop()
+
+    def is_asgi(self):
+        if self.interface is not None:
+            return self.interface == 'asgi'
+        app = self.application
+        return (asyncio.iscoroutinefunction(app) or
+                asyncio.iscoroutinefunction(getattr(app, '__call__', None)))
+
+    def serve_forever(self, poll_interval=0.5):
+        self._is_shut_down.clear()
+        self.draining = False
+        loop = self.new_event_loop()
+        try:
+            loop.run_until_complete(self.serve(poll_interval))
+        finally:
+            loop.close()
+            self._shutdown_request = False
+            self._is_shut_down.set()
+
+    async def serve(self, poll_interval):
+        self.asgi = self.is_asgi()
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.threads)
+        # asyncio closes the socket it serves, the listening socket is
+        # kept open for reexec() and server_close()
+        server = await asyncio.start_server(
+            self.handle_connection, sock=self.socket.dup(),
+            backlog=self.request_queue_size
+        )
+        try:
+            while not self._shutdown_request:
+                await asyncio.sleep(poll_interval)
+            server.close()
+            await self.drain()
+        finally:
+            server.close()
+            for task in list(self.connections):
+                task.cancel()
+            if self.connections:
+                await asyncio.wait(list(self.connections))
+            self.executor.shutdown()
+
+    async def drain(self):
+        """close idle keep-alive connections, wait ``graceful_timeout``
+        seconds for requests in progress
+        """
+        deadline = time.monotonic() + self.graceful_timeout
+        while True:
+            # connections accepted before server.close() start their tasks
+            await asyncio.sleep(0.05)
+            if not self.connections or time.monotonic() > deadline:
+                break
+            for task, busy in list(self.connections.items()):
+                if not busy:
+                    task.cancel()
+
+    async def handle_connection(self, reader, writer):
+        address = writer.get_extra_info('peername')
+        if (self.max_connections is not None and
+                len(self.connections) >= self.max_connections):
+            writer.write(self.error_response('503 Service Unavailable'))
+            try:
+                # unread request makes close() reset the connection
+                await asyncio.wait_for(reader.read(self.recv_size), 0.1)
+            except (OSError, asyncio.TimeoutError):
+                pass
+            writer.close()
+            return
+        task = asyncio.current_task()
+        parser = HTTPRequestParser(self.max_header_size, self.max_body_size)
+        requests = 0
+        try:
+            while True:
+                # idle: waiting for the next request of a keep-alive
+                # connection, the first request is waited for
+                self.connections[task] = bool(parser.buffer or
+                                              not requests)
+                request = await self.read_request(reader, writer, parser,
+                                                  requests)
+                if request is None:
+                    break
+                requests += 1
+                keep_alive = requests < self.max_keepalive_requests
+                if self.asgi:
+                    keep_alive = await self.handle_asgi(
+                        address, request, keep_alive, writer
+                    )
+                else:
+                    buffers, keep_alive = await asyncio.get_event_loop(
+                    ).run_in_executor(self.executor, self.handle_request,
+                                      address, request, keep_alive)
+                    writer.writelines(buffers)
+                await asyncio.wait_for(writer.drain(), self.timeout)
+                if not keep_alive or self.draining:
+                    break
+        except (OSError, asyncio.TimeoutError, asyncio.CancelledError):
+            pass
+        except Exception:
+            self.handle_error(address)
+        finally:
+            self.connections.pop(task, None)
+            writer.close()
+
+    async def read_request(self, reader, writer, parser, requests):
+        """read next request, None if the connection is closed"""
+        while True:
+            try:
+                request = parser.next_request()
+            except HTTPRequestError as ex:
+                writer.write(self.error_response(ex.status))
+                return None
+            if request is not None:
+                return request
+            if parser.expect_continue:
+                parser.expect_continue = False
+                writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+            if requests and not parser.buffer:
+                timeout = self.keepalive_timeout
+            else:
+                timeout = self.timeout
+            data = await asyncio.wait_for(reader.read(self.recv_size),
+                                          timeout)
+            if not data:
+                return None
+            self.connections[asyncio.current_task()] = True
+            parser.feed(data)
+
+    def handle_request(self, address, request, keep_alive):
+        """call the WSGI app in a thread, return (buffers, keep alive)"""
+        handler = self.handler_class(self, None, address)
+        try:
+            handler.handle_request(request, keep_alive)
+        except Exception:
+            self.handle_error(address)
+            return [self.error_response('500 Internal Server Error')], False
+        return handler.output, handler.keep_alive
+
+    async def handle_asgi(self, address, request, keep_alive, writer):
+        """call the ASGI app, return whether the connection can be kept"""
+        start_time = time.time()
+        start = time.perf_counter()
+        path, _, query = request.path.partition('?')
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0', 'spec_version': '2.3'},
+            'http_version': request.version.split('/', 1)[-1],
+            'method': request.method,
+            'scheme': 'http',
+            'path': urllib.parse.unquote(path),
+            'raw_path': path.encode('latin-1'),
+            'query_string': query.encode('latin-1'),
+            'root_path': '',
+            'headers': [(k.lower().encode('latin-1'), v.encode('latin-1'))
+                        for k, v in request.headers.items()],
+            'client': address[:2],
+            'server': (self.server_name, self.server_port),
+        }
+        state = {
+            'keep_alive': (keep_alive and request.keep_alive and
+                           self.keepalive_timeout > 0 and not self.draining),
+            'status': None, 'headers': None, 'started': False,
+            'chunked': False, 'finished': False, 'bytes': 0,
+        }
+        finished = asyncio.Event()
+        body_sent = False
+
+        async def receive():
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {'type': 'http.request', 'body': request.body,
+                        'more_body': False}
+            await finished.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                state['status'] = message['status']
+                state['headers'] = list(message.get('headers', []))
+                return
+            if message['type'] != 'http.response.body' or state['finished']:
+                return
+            body = message.get('body', b'')
+            more_body = message.get('more_body', False)
+            buffers = []
+            if not state['started']:
+                buffers.append(self.asgi_headers(request, state, body,
+                                                 more_body))
+            if request.method != 'HEAD':
+                if state['chunked']:
+                    if body:
+                        buffers.extend((b'%x\r\n' % len(body), body,
+                                        b'\r\n'))
+                    if not more_body:
+                        buffers.append(b'0\r\n\r\n')
+                else:
+                    buffers.append(body)
+            if not more_body:
+                state['finished'] = True
+                finished.set()
+            state['bytes'] += sum(map(len, buffers))
+            writer.writelines(buffers)
+            await asyncio.wait_for(writer.drain(), self.timeout)
+
+        try:
+            await self.application(scope, receive, send)
+        except Exception:
+            self.handle_error(address)
+            if not state['started']:
+                writer.write(
+                    self.error_response('500 Internal Server Error')
+                )
+            return False
+        finally:
+            finished.set()
+        if not state['finished']:
+            if not state['started']:
+                # no response
+                writer.write(
+                    self.error_response('500 Internal Server Error')
+                )
+            return False
+        if self.access_logger:
+            self.access_logger.log({
+                'remote_addr': address[0],
+                'time': start_time,
+                'method': request.method,
+                'path': request.path,
+                'protocol': request.version,
+                'status': state['status'],
+                'bytes': state['bytes'],
+                'latency': (time.perf_counter() - start) * 1000,
+                'user_agent': request.headers.get('User-Agent', '-'),
+                'referer': request.headers.get('Referer', '-'),
+            })
+        return state['keep_alive']
+
+    def asgi_headers(self, request, state, body, more_body):
+        """status line and headers of ASGI response"""
+        state['started'] = True
+        status = state['status']
+        headers = state['headers']
+        names = {k.lower() for k, _ in headers}
+        for name, value in headers:
+            if name.lower() == b'connection' and value.lower() == b'close':
+                state['keep_alive'] = False
+        if b'content-length' not in names and status not in (204, 304):
+            if not more_body:
+                headers.append((b'content-length', str(len(body)).encode()))
+            elif request.version == 'HTTP/1.1':
+                headers.append((b'transfer-encoding', b'chunked'))
+                state['chunked'] = request.method != 'HEAD'
+            else:
+                state['keep_alive'] = False
+        if not state['keep_alive']:
+            headers.append((b'connection', b'close'))
+        elif request.version == 'HTTP/1.0':
+            headers.append((b'connection', b'keep-alive'))
+        try:
+            reason = http.HTTPStatus(status).phrase
+        except ValueError:
+            reason = ''
+        status_line = b'%s%d %s\r\n' % (
+            self.status_line_prefix, status, reason.encode('latin-1')
+        )
+        lines = [status_line, self.server_headers()]
+        lines.extend(b'%s: %s\r\n' % (k, v) for k, v in headers)
+        lines.append(b'\r\n')
+        return b''.join(lines)
+
+
+# environment variables passed to the re-executed process
+LISTEN_FD_ENV = 'BUSTARD_LISTEN_FD'
+WORKERS_ENV = 'BUSTARD_WORKERS'
+
+
+def inherited_fd():
+    """file descriptor of the listening socket inherited from the process
+    which re-executed this one, None if there isn't one
+    """
+    fd = os.environ.pop(LISTEN_FD_ENV, None)
+    return int(fd) if fd else None
+
+
+def reexec(sock=None, **env):
+    """replace the current process (the pid doesn't change) by running its
+    command line again, the new process inherits the listening socket
+    ``sock`` and gets ``env`` as environment variables
+    """
+    env = dict(os.environ, **env)
+    if sock is not None:
+        os.set_inheritable(sock.fileno(), True)
+        env[LISTEN_FD_ENV] = str(sock.fileno())
+    if hasattr(sys, 'orig_argv'):
+        argv = [sys.executable] + sys.orig_argv[1:]
+    else:
+        spec = getattr(sys.modules['__main__'], '__spec__', None)
+        if spec is not None:
+            # python -m package
+            name = spec.name
+            if name.endswith('.__main__'):
+                name = name[:-len('.__main__')]
+            argv = [sys.executable, '-m', name] + sys.argv[1:]
+        else:
+            argv = [sys.executable] + sys.argv
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.execve(sys.executable, argv, env)
+
+
+def run_server(server):
+    """``server.serve_forever()`` with signal handlers:
+
+    * SIGTERM, SIGINT: graceful shutdown, requests in progress are
+      finished, their connections are closed after ``graceful_timeout``
+      seconds
+    * SIGHUP, SIGUSR2: reload, after the graceful shutdown the process is
+      re-executed and inherits the listening socket, connections wait in
+      the listen backlog instead of being refused
+    """
+    reload = False
+    # the request in progress blocks the single threaded WSGIServer
+    timer = threading.Timer(server.graceful_timeout, server.close_connections)
+    timer.daemon = True
+
+    def handle_signal(signum, frame):
+        nonlocal reload
+        reload = signum in (signal.SIGHUP, signal.SIGUSR2)
+        server.shutdown(wait=False)
+        if timer.ident is None:
+            timer.start()
+
+    signals = (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGUSR2)
+    handlers = {signum: signal.signal(signum, handle_signal)
+                for signum in signals}
+    try:
+        server.serve_forever()
+    finally:
+        timer.cancel()
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+    if not reload:
+        server.server_close()
+        return
+    if server.access_logger:
+        server.access_logger.close()
+    reexec(server.socket)
+
+
+class PreforkMaster:
+    """pre-fork master process: fork ``workers`` processes which serve
+    requests of the same listening socket, restart crashed workers.
+
+    signals of master:
+
+    * SIGTERM, SIGINT: graceful shutdown, workers finish requests in
+      progress, they are killed after ``graceful_timeout`` seconds
+    * SIGHUP: rolling restart, workers are replaced one by one
+    * SIGUSR2: reload, the master is re-executed (same pid) to load new
+      code, it inherits the listening socket and the workers, the old
+      workers are stopped gracefully after new ones are started
+    * SIGTTIN, SIGTTOU: increase, decrease the number of workers
+
+    The socket is bound by master and inherited by workers, with
+    ``reuse_port=True`` every worker binds its own ``SO_REUSEPORT`` socket.
+    """
+    server_class = WSGIServer
+    graceful_timeout = 30
+
+    def __init__(self, server_address, application, workers=2, threads=None,
+                 reuse_port=False, graceful_timeout=None, **kwargs):
+        self.server_address = server_address
+        self.application = application
+        self.num_workers = workers
+        self.reuse_port = reuse_port
+        if graceful_timeout is not None:
+            self.graceful_timeout = graceful_timeout
+        self.server_kwargs = dict(kwargs, threads=threads)
+        # workers of the master which re-executed this one
+        self.inherited_workers = [
+            int(pid) for pid in os.environ.pop(WORKERS_ENV, '').split(',')
+            if pid
+        ]
+        fd = inherited_fd()
+        self.server = None
+        if not reuse_port:
+            self.server = self.make_server(fd=fd)
+            self.server_address = self.server.server_address
+        self.pid = os.getpid()
+        self.workers = {}    # pid -> worker id
+        self._worker_ids = iter(range(1, sys.maxsize))
+        self._signals = []
+        self._restarting = []   # pids of workers to be replaced
+        self._retiring = {}     # pid -> deadline of stopping workers
+        self._stopping = False
+
+    def make_server(self, fd=None):
+        server = make_server(self.server_address, self.application,
+                             reuse_port=self.reuse_port, fd=fd,
+                             **self.server_kwargs)
+        server.multiprocess = True
+        server.graceful_timeout = self.graceful_timeout
+        return server
+
+    def run(self):
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        for sock in (self._wakeup_r, self._wakeup_w):
+            sock.setblocking(False)
+        signal.set_wakeup_fd(self._wakeup_w.fileno())
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP,
+                       signal.SIGUSR2, signal.SIGTTIN, signal.SIGTTOU,
+                       signal.SIGCHLD):
+            signal.signal(signum, self.handle_signal)
+        try:
+            self.spawn_workers()
+            # new workers accept connections, stop the old ones
+            deadline = time.monotonic() + self.graceful_timeout
+            for pid in self.inherited_workers:
+                self._retiring[pid] = deadline
+                self.kill_worker(pid, signal.SIGTERM)
+            self.inherited_workers = []
+            while not self._stopping or self.workers or self._retiring:
+                self.wait_signals(1.0)
+                self.reap_workers()
+                self.handle_signals()
+                self.manage_workers()
+        finally:
+            self.kill_workers(signal.SIGKILL)
+            signal.set_wakeup_fd(-1)
+            self._wakeup_r.close()
+            self._wakeup_w.close()
+            if self.server is not None:
+                self.server.server_close()
+
+    def handle_signal(self, signum, frame):
+        self._signals.append(signum)
+
+    def wait_signals(self, timeout):
+        if self._signals:
+            return
+        try:
+            select.select([self._wakeup_r], [], [], timeout)
+            while self._wakeup_r.recv(1024):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def handle_signals(self):
+        while self._signals:
+            signum = self._signals.pop(0)
+            if signum in (signal.SIGTERM, signal.SIGINT):
+                self.stop()
+            elif signum == signal.SIGHUP:
+                self.restart_workers()
+            elif signum == signal.SIGUSR2:
+                self.reload()
+            elif signum == signal.SIGTTIN:
+                self.num_workers += 1
+            elif signum == signal.SIGTTOU and self.num_workers > 1:
+                self.num_workers -= 1
+
+    def stop(self):
+        """graceful shutdown"""
+        self._stopping = True
+        self._restarting = []
+        for pid in list(self.workers):
+            self.retire_worker(pid)
+
+    def restart_workers(self):
+        """replace workers one by one"""
+        if not self._stopping:
+            self._restarting = list(self.workers)
+
+    def reload(self):
+        """re-execute the master, it inherits the workers and stops them
+        after starting new ones
+        """
+        if self._stopping:
+            return
+        pids = ','.join(map(str, list(self.workers) + list(self._retiring)))
+        signal.set_wakeup_fd(-1)
+        try:
+            reexec(self.server and self.server.socket, **{WORKERS_ENV: pids})
+        except OSError:
+            traceback.print_exc()
+            signal.set_wakeup_fd(self._wakeup_w.fileno())
+
+    def manage_workers(self):
+        if self._stopping:
+            return
+        # replace the next worker after the previous one has exited
+        if self._restarting and not self._retiring:
+            pid = self._restarting.pop(0)
+            if pid in self.workers:
+                self.spawn_worker()
+                self.retire_worker(pid)
+        # restart crashed workers
+        self.spawn_workers()
+        # SIGTTOU
+        extra = len(self.workers) - self.num_workers
+        for pid in list(self.workers)[:max(extra, 0)]:
+            self.retire_worker(pid)
+
+    def spawn_workers(self):
+        while len(self.workers) < self.num_workers:
+            self.spawn_worker()
+
+    def spawn_worker(self):
+        worker_id = next(self._worker_ids)
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = worker_id
+            return pid
+
+        # worker process
+        exit_code = 0
+        try:
+            self.run_worker(worker_id)
+        except BaseException:
+            exit_code = 1
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(exit_code)
+
+    def run_worker(self, worker_id):
+        signal.set_wakeup_fd(-1)
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+        for signum in (signal.SIGHUP, signal.SIGUSR2, signal.SIGTTIN,
+                       signal.SIGTTOU, signal.SIGCHLD):
+            signal.signal(signum, signal.SIG_DFL)
+        # master handles ctrl+c and stops workers with SIGTERM
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        server = self.server or self.make_server()
+        signal.signal(signal.SIGTERM,
+                      lambda signum, frame: server.shutdown(wait=False))
+        try:
+            server.serve_forever()
+        finally:
+            # flush access log
+            server.server_close()
+
+    def retire_worker(self, pid):
+        if self.workers.pop(pid, None) is None:
+            return
+        self._retiring[pid] = time.monotonic() + self.graceful_timeout
+        self.kill_worker(pid, signal.SIGTERM)
+
+    def kill_worker(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError as ex:
+            if ex.errno != errno.ESRCH:
+                raise
+
+    def kill_workers(self, signum):
+        for pid in list(self.workers) + list(self._retiring):
+            self.kill_worker(pid, signum)
+
+    def reap_workers(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if not pid:
+                break
+            if self.workers.pop(pid, None) is not None:
+                print('worker {} exited unexpectedly with status {}'.format(
+                    pid, status
+                ), file=sys.stderr)
+            self._retiring.pop(pid, None)
+
+        now = time.monotonic()
+        for pid, deadline in list(self._retiring.items()):
+            if now > deadline:
+                self.kill_worker(pid, signal.SIGKILL)
+
+
+def make_server(server_address, application, threads=None,
+                server_class=None, **kwargs):
+    """create a WSGIServer, ``threads`` > 0 creates a ThreadPoolWSGIServer"""
+    if server_class is not None:
+        if threads is not None:
+            kwargs['threads'] = threads
+        server = server_class(server_address, **kwargs)
+    elif threads:
+        server = ThreadPoolWSGIServer(server_address, threads=threads,
+                                      **kwargs)
+    else:
+        server = WSGIServer(server_address, **kwargs)
+    server.set_app(application)
+    return server
@@ -47,6 +47,7 @@ setup(
     include_package_data=True,
     install_requires=requirements,
     zip_safe=False,
+    python_requires='>=3.7',
     platforms='any',
     classifiers=[
         'Development Status :: 3 - Alpha',
@@ -56,7 +57,8 @@ setup(
         'Operating System :: OS Independent',
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
         'Topic :: Internet :: WWW/HTTP :: Dynamic Content',
         'Topic :: Software Development :: Libraries :: Python Modules'
     ],
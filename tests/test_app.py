@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import os
 
 import pytest
 
+from bustard import servers
 from bustard.app import Bustard
+from bustard.servers import ServerAdapter
+from bustard.template import TemplateSyntaxError
 from .utils import CURRENT_DIR
 
 app = Bustard(template_dir=os.path.join(CURRENT_DIR, 'templates'))
@@ -23,3 +27,98 @@ def test_hello(client):
     url = app.url_for('hello', name='Tom')
     response = client.get(url)
     assert response.data.strip() == b'hello Tom /hello/Tom'
+
+
+def test_render_template_cache(client):
+    app.template_cache.clear()
+    for name in ('Tom', 'Jerry'):
+        client.get(app.url_for('hello', name=name))
+    assert len(app.template_cache) == 1
+
+
+def test_render_template_async():
+    html = asyncio.run(app.render_template_async('hello.html', name='Tom'))
+    assert html.strip() == b'hello Tom /hello/Tom'
+
+
+def test_preload_templates():
+    app.template_cache.clear()
+    names = app.preload_templates()
+    assert 'hello.html' in names
+    assert 'child.html' in names
+    assert ('template', os.path.join(app.template_dir, 'hello.html')
+            ) in app.template_cache
+
+
+def test_preload_templates_error(tmpdir):
+    tmpdir.join('ok.html').write('{{ a }}')
+    tmpdir.join('bad.html').write('{% if a %}')
+    tmpdir.join('bad2.html').write('{{ a b }}')
+    _app = Bustard(template_dir=str(tmpdir))
+    with pytest.raises(TemplateSyntaxError) as excinfo:
+        _app.preload_templates()
+    message = str(excinfo.value)
+    assert 'bad.html' in message
+    assert 'bad2.html' in message
+    assert 'ok.html' not in message
+
+
+def test_template_profile_report(client):
+    app.template_cache.clear()
+    app.config['TEMPLATE_PROFILE'] = True
+    try:
+        client.get(app.url_for('hello', name='Tom'))
+    finally:
+        app.config['TEMPLATE_PROFILE'] = False
+        app.template_cache.clear()
+    assert 'template hello.html' in app.template_profile_report()
+
+
+def test_template_sandbox_config(tmpdir):
+    tmpdir.join('class.html').write('{{ x.__class__ }}')
+    _app = Bustard(template_dir=str(tmpdir))
+    assert b'int' in _app.render_template('class.html', x=1)
+    # a template cached before TEMPLATE_SANDBOX is set isn't used
+    _app.config['TEMPLATE_SANDBOX'] = True
+    with pytest.raises(TemplateSyntaxError):
+        _app.render_template('class.html', x=1)
+
+
+def test_template_debug_reload(tmpdir):
+    tmpdir.join('index.html').write('{% include "a.html" %}')
+    tmpdir.join('a.html').write('a')
+    _app = Bustard(template_dir=str(tmpdir))
+    assert _app.render_template('index.html') == b'a'
+    tmpdir.join('a.html').write('b')
+    assert _app.render_template('index.html') == b'a'
+    _app.config['DEBUG'] = True
+    assert _app.render_template('index.html') == b'b'
+
+
+class DummyServer(ServerAdapter):
+    instances = []
+
+    def run(self, app):
+        self.app = app
+        self.instances.append(self)
+
+
+def test_run_server():
+    app.run(port=8000, server=DummyServer, threads=2)
+    server = DummyServer.instances.pop()
+    assert server.app is app
+    assert (server.host, server.port) == ('127.0.0.1', 8000)
+    assert server.options == {'threads': 2}
+
+
+def test_run_server_default(monkeypatch):
+    class DummyThreadedServer(DummyServer, servers.ThreadedServer):
+        pass
+
+    monkeypatch.setitem(servers.SERVERS, 'threaded', DummyThreadedServer)
+    app.run(threads=8)
+    server = DummyServer.instances.pop()
+    assert isinstance(server, servers.ThreadedServer)
+    assert server.options == {'threads': 8}
+    with pytest.raises(ValueError):
+        app.run(backlog=64)
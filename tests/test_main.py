@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from bustard import servers
+from bustard.__main__ import import_app, main
+from .test_app import app, DummyServer
+from .test_wsgi_server import echo_port
+
+
+class DummyPreforkServer(DummyServer, servers.PreforkServer):
+    pass
+
+
+def test_import_app():
+    assert import_app('tests.test_app') is app
+    assert import_app('tests.test_wsgi_server:echo_port') is echo_port
+    with pytest.raises(ValueError):
+        import_app('tests.test_app:abc')
+
+
+@pytest.mark.parametrize('argv, server_name, options', [
+    (['tests.test_wsgi_server:echo_port', '--threads', '3',
+      '--keepalive', '2'], 'bustard', {'threads': 3, 'keepalive_timeout': 2}),
+    (['tests.test_app:app', '--port', '8000', '--server', 'asyncio',
+      '--backlog', '100'], 'asyncio', {'backlog': 100}),
+    (['tests.test_app:app', '--workers', '4'], 'prefork', {'workers': 4}),
+])
+def test_main(monkeypatch, argv, server_name, options):
+    monkeypatch.setitem(servers.SERVERS, server_name, DummyPreforkServer)
+    main(argv)
+    server = DummyServer.instances.pop()
+    assert server.app is import_app(argv[0])
+    assert server.options == options
+    assert server.port == (8000 if '--port' in argv else 5000)
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from bustard.servers import (
+    AsyncioServer, get_server_adapter, PreforkServer, ThreadedServer
+)
+
+
+@pytest.mark.parametrize('name, server_class', [
+    ('threaded', ThreadedServer),
+    ('asyncio', AsyncioServer),
+    (AsyncioServer, AsyncioServer),
+])
+def test_get_server_adapter(name, server_class):
+    server = get_server_adapter(name, port=8000, threads=4, backlog=64,
+                                keepalive=0, timeout=10)
+    assert type(server) is server_class
+    assert server.port == 8000
+    assert server.options == {'threads': 4, 'backlog': 64,
+                              'keepalive_timeout': 0, 'timeout': 10}
+
+
+def test_get_server_adapter_prefork():
+    server = get_server_adapter('prefork', workers=3)
+    assert isinstance(server, PreforkServer)
+    assert server.options == {'workers': 3}
+
+
+@pytest.mark.parametrize('name, options', [
+    ('abc', {}),
+    ('threaded', {'workers': 2}),
+    ('wsgiref', {'threads': 8}),
+    ('wsgiref', {'backlog': 64}),
+    ('werkzeug', {'keepalive': 5}),
+])
+def test_get_server_adapter_error(name, options):
+    with pytest.raises(ValueError):
+        get_server_adapter(name, **options)
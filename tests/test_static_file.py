@@ -38,3 +38,25 @@ def test_ok(client, filename):
 def test_404(client, filename):
     response = client.get('/{}'.format(filename))
     assert response.status_code == 404
+
+
+@pytest.mark.parametrize('value, status_code, content_range, slice_', [
+    ('bytes=0-9', 206, 'bytes 0-9/{}', slice(0, 10)),
+    ('bytes=10-', 206, 'bytes 10-{1}/{0}', slice(10, None)),
+    ('bytes=-5', 206, 'bytes {2}-{1}/{0}', slice(-5, None)),
+    ('bytes=0-99999999', 206, 'bytes 0-{1}/{0}', slice(None)),
+    ('bytes=0-1,3-4', 200, None, slice(None)),
+    ('bytes=a-b', 200, None, slice(None)),
+    ('bytes=99999999-', 416, 'bytes */{}', slice(0)),
+])
+def test_range(client, value, status_code, content_range, slice_):
+    response = client.get('/test.png', headers={'Range': value})
+    with open(os.path.join(current_dir, 'test.png'), 'rb') as fp:
+        content = fp.read()
+    size = len(content)
+    assert response.status_code == status_code
+    assert response.headers.get('Content-Range') == (
+        content_range and content_range.format(size, size - 1, size - 5)
+    )
+    if status_code != 416:
+        assert response.content == content[slice_]
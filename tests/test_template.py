@@ -1,12 +1,18 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, unicode_literals
+import asyncio
 import collections
 import os
+import time
+import types
 
 import pytest
 
-from bustard.template import Template
+from bustard.template import (
+    escape, html_escape, LRUCache, noescape, Template, TemplateCache,
+    TemplateProfiler, TemplateSyntaxError
+)
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 template_dir = os.path.join(current_dir, 'templates')
@@ -59,6 +65,12 @@ test_data = (
      '{% endfor %}',
      {'items': ['a', 'b', 'c']}, '0a,1b,2c,'),
 
+    # attribute and subscript targets
+    ('{% for d[k] in items %}{% endfor %}{{ d[k] }}',
+     {'d': {}, 'k': 'a', 'items': [1, 2]}, '2'),
+    ('{% for obj.attr in items %}{% endfor %}{{ obj.attr }}',
+     {'obj': types.SimpleNamespace(), 'items': [1, 2]}, '2'),
+
     # for + if
     ('{% for item in items %}' +
      '{% if item > 2 %}{{ item }}{% endif %}' +
@@ -75,6 +87,11 @@ test_data = (
     ('{{ sum(filter(lambda x: x > 2, numbers)) }}',
      {'numbers': [1, 2, 3, 2, 4]}, '7'),
 
+    # names only used by branches not rendered
+    ('{% if abc %}{{ efg }}{% endif %}', {'abc': 0}, ''),
+    # context overrides builtins
+    ('{{ len }}', {'len': 'foo'}, 'foo'),
+
     ('{{ noescape(str) }}', {}, "<class 'str'>"),
     ('{{ noescape(abs) }}', {}, '<built-in function abs>'),
 )
@@ -93,12 +110,169 @@ def test_base(tpl, context, result):
     ('{{ SystemExit }}', {}),
     ('{{ __name__ }}', {}),
     ('{{ __import__ }}', {}),
+    ('{% if hello %}{% endif %}', {}),
+    ('{{ hello.world }}', {}),
+    ('{% for x in hello %}{% endfor %}', {}),
 ])
 def test_name_error(tpl, context):
     with pytest.raises(NameError):
         assert Template(tpl).render(**context)
 
 
+@pytest.mark.parametrize(('value', 'result'), [
+    ('', ''),
+    ('hello', 'hello'),
+    ('<a href="/?a=1&b=2">it\'s</a>',
+     '&lt;a href=&quot;/?a=1&amp;b=2&quot;&gt;it&apos;s&lt;/a&gt;'),
+    ('&amp;', '&amp;amp;'),
+])
+def test_html_escape(value, result):
+    assert html_escape(value) == result
+
+
+@pytest.mark.parametrize(('value', 'result'), [
+    (1, '1'),
+    (1.5, '1.5'),
+    (True, 'True'),
+    (None, 'None'),
+    (b'<b>', '&lt;b&gt;'),
+    (['<'], '[&apos;&lt;&apos;]'),
+    (noescape('<b>'), '<b>'),
+])
+def test_escape(value, result):
+    assert escape(value) == result
+
+
+@pytest.mark.parametrize(('tpl', 'context', 'result'), [
+    ('a{% if x %}b{# c #}c{% elif y %}d{% else %}e{% endif %}f',
+     {'x': 0, 'y': 1}, 'adf'),
+    ('{% for x in xs %}{% if x %}y{% endif %}{% endfor %}',
+     {'xs': [0, 1]}, 'y'),
+    ('{% if x %}{% endif %}{% for i in xs %}{% endfor %}',
+     {'x': 1, 'xs': [1]}, ''),
+])
+def test_fold_strings(tpl, context, result):
+    template = Template(tpl)
+    code = str(template.code_builder)
+    assert ' if ' not in code.replace(' if (', '')
+    assert template.render(**context) == result
+
+
+def test_merge_strings():
+    template = Template('a{# b #}c{{ d }}e{% if f %}g{% endif %}')
+    assert "'ac', escape(d), 'e'" in str(template.code_builder)
+    assert template.render(d=1, f=1) == 'ac1eg'
+
+
+def test_cache_fragment():
+    fragment_cache = LRUCache()
+    calls = []
+
+    def load(n):
+        calls.append(n)
+        return n
+
+    template = Template(
+        '{% cache ("nav", n) %}{% for x in range(load(n)) %}{{ x }}'
+        '{% endfor %}{% endcache %}!', fragment_cache=fragment_cache
+    )
+    assert template.render(load=load, n=2) == '01!'
+    assert template.render(load=load, n=2) == '01!'
+    assert template.render(load=load, n=3) == '012!'
+    assert calls == [2, 3]
+    assert fragment_cache.get(('nav', 2)) == '01'
+
+    fragment_cache.delete(('nav', 2))
+    assert template.render(load=load, n=2) == '01!'
+    assert calls == [2, 3, 2]
+
+
+def test_cache_fragment_ttl():
+    fragment_cache = LRUCache()
+    template = Template('{% cache "time" 0.01 %}{{ now() }}{% endcache %}',
+                        fragment_cache=fragment_cache)
+    result = template.render(now=time.time)
+    assert template.render(now=time.time) == result
+    time.sleep(0.02)
+    assert template.render(now=time.time) != result
+
+
+def test_lru_cache():
+    cache = LRUCache(max_size=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert 'b' not in cache
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+
+
+@pytest.mark.parametrize('tpl', [
+    '{% if a %}',
+    '{% endif %}',
+    '{% for a in b %}{% else %}{% endfor %}',
+    '{% cache a %}',
+    '{% endcache %}',
+    '{% macro a() %}',
+    '{% macro a %}{% endmacro %}',
+    '{% call a() %}{% endcall %}{% endcall %}',
+    '{% call a %}{% endcall %}',
+    '{{ a b }}',
+])
+def test_syntax_error(tpl):
+    with pytest.raises(TemplateSyntaxError):
+        Template(tpl)
+
+
+def test_render_many_times():
+    template = Template('{% for x in items %}{{ x }}{% endfor %}{{ name }}')
+    render_function = template.render_function
+    assert template.render(items=[1, 2], name='a') == '12a'
+    assert template.render(items=[3], name='b') == '3b'
+    assert template.render_function is render_function
+
+
+@pytest.mark.parametrize(('tpl', 'context', 'result'), [
+    ('{% macro hello(name) %}<b>{{ name }}</b>{% endmacro %}'
+     '{{ hello(a) }}{{ hello("<") }}',
+     {'a': 'a'}, '<b>a</b><b>&lt;</b>'),
+    # macros can be used before they are defined
+    ('{{ hello() }}{% macro hello(name=a) %}{{ name }}{% endmacro %}',
+     {'a': 'a'}, 'a'),
+    ('{% macro hello(name, **kwargs) %}{{ name }}{{ kwargs["b"] }}'
+     '{% endmacro %}{{ hello("a", b=1) }}',
+     {}, 'a1'),
+    ('{% macro wrap(tag) %}<{{ tag }}>{{ caller() }}</{{ tag }}>'
+     '{% endmacro %}'
+     '{% for x in items %}{% call wrap("p") %}{{ x }}{% endcall %}'
+     '{% endfor %}',
+     {'items': ['a', '<']}, '<p>a</p><p>&lt;</p>'),
+])
+def test_macro(tpl, context, result):
+    assert Template(tpl).render(**context) == result
+
+
+def test_no_auto_escape():
+    template = Template('{% macro b(x) %}<b>{{ x }}</b>{% endmacro %}'
+                        '{{ a }}{{ b(a) }}', auto_escape=False)
+    assert template.render(a='<') == '<<b><</b>'
+
+
+def test_macro_defined_once():
+    template = Template(
+        '{% macro row(item) %}<li>{{ item }}</li>{% endmacro %}'
+        '<ul>{% for item in items %}{{ row(item) }}{% endfor %}</ul>'
+    )
+    code = str(template.code_builder)
+    assert code.count('def row(') == 1
+    assert code.index('def row(') < code.index('for item in items')
+    assert template.render(items=range(3)) == (
+        '<ul><li>0</li><li>1</li><li>2</li></ul>'
+    )
+
+
 def test_include():
     with open(os.path.join(template_dir, 'index.html')) as fp:
         template = Template(fp.read(), template_dir=template_dir)
@@ -111,6 +285,63 @@ def test_include():
     )
 
 
+def test_include_defined_once():
+    with open(os.path.join(template_dir, 'include_twice.html')) as fp:
+        template = Template(fp.read(), template_dir=template_dir)
+    code = str(template.code_builder)
+    assert code.count('def ') == 2
+    # static template is inlined
+    assert "'<hr>\\n'" in code
+    assert template.render(items=[1, 2]) == (
+        '<li>1</li><li>2</li>\n<hr>\n'
+        '<li>1</li><li>2</li>\n<hr>\n'
+        '<li>1</li><li>2</li>\n'
+    )
+
+
+def test_include_template_cache():
+    template_cache = TemplateCache()
+    for _ in range(2):
+        with open(os.path.join(template_dir, 'include_twice.html')) as fp:
+            Template(fp.read(), template_dir=template_dir,
+                     template_cache=template_cache)
+    assert len(template_cache) == 2
+
+
+@pytest.mark.parametrize('tpl, context, expect', [
+    ('{% cache "nav" %}{% for item in nav %}{% include "row.html" %}'
+     '{% endfor %}{% endcache %}', {'nav': [1, 2]},
+     '<li>1</li><li>2</li>'),
+    ('{% macro m(item) %}{% include "row.html" %}{% endmacro %}'
+     '{{ m(1) }}{{ m(2) }}', {}, '<li>1</li><li>2</li>'),
+    ('{% macro wrap() %}<ul>{{ caller() }}</ul>{% endmacro %}'
+     '{% call wrap() %}{% for item in items %}{% include "row.html" %}'
+     '{% endfor %}{% endcall %}', {'items': [1, 2]},
+     '<ul><li>1</li><li>2</li></ul>'),
+    ('{% for item in [1] %}{% include "row.html" %}{% endfor %}'
+     '{% macro m(item) %}{% include "row.html" %}{% endmacro %}{{ m(2) }}',
+     {}, '<li>1</li><li>2</li>'),
+])
+def test_include_in_function(tmpdir, tpl, context, expect):
+    tmpdir.join('row.html').write('<li>{{ item }}</li>')
+    template = Template(tpl, template_dir=str(tmpdir),
+                        fragment_cache=LRUCache())
+    assert template.render(**context) == expect
+
+
+def test_include_in_cache_async(tmpdir):
+    tmpdir.join('row.html').write('<li>{{ item }}</li>')
+    template = Template(
+        '{% cache "nav" %}{% for item in nav %}{% include "row.html" %}'
+        '{% endfor %}{% endcache %}', template_dir=str(tmpdir),
+        enable_async=True, fragment_cache=LRUCache()
+    )
+
+    async def render():
+        return await template.render_async(nav=[1, 2])
+    assert asyncio.run(render()) == '<li>1</li><li>2</li>'
+
+
 def test_extends():
     with open(os.path.join(template_dir, 'child.html')) as fp:
         template = Template(fp.read(), template_dir=template_dir)
@@ -127,3 +358,151 @@ yes
 '''
     result = template.render(items=[1, 2, 3])
     assert result == expect
+
+
+def test_extends_chain():
+    cache = TemplateCache()
+    with open(os.path.join(template_dir, 'grandchild.html')) as fp:
+        template = Template(fp.read(), template_dir=template_dir,
+                            template_cache=cache)
+    expect = '''<html>
+<p>hello</p>
+child_header parent_header
+<p>world</p>
+grandchild_footer child_footer
+<ul><li>1</li><li>2</li><li>3</li>
+</ul>
+<p>!</p>
+</html>
+'''
+    assert template.render(items=[1, 2, 3]) == expect
+    # parent templates are parsed once
+    key = ('tree', os.path.abspath(os.path.join(template_dir, 'child.html')))
+    tree = cache.get(key)
+    assert tree is not None
+    Template('{% extends "child.html" %}', template_dir=template_dir,
+             template_cache=cache)
+    assert cache.get(key) is tree
+
+
+def test_nested_blocks(tmpdir):
+    tmpdir.join('base.html').write(
+        '{% block a %}a{% block b %}b{% endblock %}{% endblock %}'
+    )
+    tpl = ('{% extends "base.html" %}'
+           '{% block b %}[{{ block.super }}]{% endblock %}')
+    template = Template(tpl, template_dir=str(tmpdir))
+    assert template.render() == 'a[b]'
+    tpl = '{% extends "base.html" %}{% block a %}{% endblock %}'
+    template = Template(tpl, template_dir=str(tmpdir))
+    assert template.render() == ''
+
+
+def test_extends_macro(tmpdir):
+    tmpdir.join('base.html').write(
+        '{% macro m() %}base{% endmacro %}{% block a %}{% endblock %}'
+        '{{ m() }}'
+    )
+    tmpdir.join('child.html').write(
+        '{% extends "base.html" %}{% macro m() %}M{% endmacro %}'
+        '{% block a %}{{ m() }}{% endblock %}'
+    )
+    tpl = '{% extends "child.html" %}{% block a %}[{{ m() }}]{% endblock %}'
+    template = Template(tpl, template_dir=str(tmpdir))
+    assert template.render() == '[M]M'
+    tpl = tmpdir.join('child.html').read()
+    template = Template(tpl, template_dir=str(tmpdir))
+    assert template.render() == 'MM'
+
+
+def test_syntax_error_lineno():
+    with pytest.raises(TemplateSyntaxError) as excinfo:
+        Template('a\nb\n{% endfor %}', name='a.html')
+    assert 'a.html:3' in str(excinfo.value)
+
+
+@pytest.mark.parametrize('tpl', [
+    '{{ a.__class__ }}',
+    '{{ a._private }}',
+    '{{ __context }}',
+    "{{ '{0.__class__}'.format(a) }}",
+    '{% for __get in a %}{% endfor %}',
+    '{% if a.__dict__ %}{% endif %}',
+    '{% macro m(_x) %}{% endmacro %}',
+    '{{ a.ag_frame }}',
+    '{{ a.ag_code }}',
+    '{{ [0 for a.is_admin in [1]] }}',
+    '{% for a.is_admin in [True] %}{% endfor %}',
+    '{% for a["is_admin"] in [True] %}{% endfor %}',
+])
+def test_sandbox_syntax_error(tpl):
+    Template(tpl)
+    with pytest.raises(TemplateSyntaxError):
+        Template(tpl, sandbox=True)
+
+
+def test_sandbox():
+    class Foo:
+        bar = 'baz'
+
+    template = Template('{{ a.bar }}{{ len(b) }}{{ getattr }}', sandbox=True)
+    assert template.render(a=Foo(), b=[1], getattr='x') == 'baz1x'
+    with pytest.raises(NameError):
+        Template('{{ getattr(a, "bar") }}', sandbox=True).render(a=Foo())
+    with pytest.raises(NameError):
+        Template('{{ type(a) }}', sandbox=True).render(a=Foo())
+
+
+def test_async():
+    async def fetch(value):
+        await asyncio.sleep(0)
+        return value
+
+    async def items():
+        for i in range(3):
+            yield await fetch(i)
+
+    template = Template(
+        '{{ await fetch("<a>") }}{{ await b }}'
+        '{% async for x in items() %}{{ x }}{% endfor %}'
+        '{% cache "c" %}{{ await fetch(1) }}{% endcache %}',
+        enable_async=True, fragment_cache=LRUCache()
+    )
+
+    async def render():
+        b = asyncio.ensure_future(fetch('b'))
+        return await template.render_async(fetch=fetch, b=b, items=items)
+
+    expect = '&lt;a&gt;b0121'
+    assert asyncio.run(render()) == expect
+    assert template.render(fetch=fetch, b=fetch('b'), items=items) == expect
+
+
+@pytest.mark.parametrize('tpl', [
+    '{{ await a }}',
+    '{% async for x in a %}{% endfor %}',
+])
+def test_async_syntax_error(tpl):
+    with pytest.raises(TemplateSyntaxError):
+        Template(tpl)
+    Template(tpl, enable_async=True)
+
+
+def test_profiler():
+    profiler = TemplateProfiler()
+    with open(os.path.join(template_dir, 'child.html')) as fp:
+        template = Template(fp.read(), template_dir=template_dir,
+                            profiler=profiler, name='child.html')
+    result = template.render(items=[1, 2, 3])
+    assert 'child_header parent_header' in result
+    template.render(items=[1])
+    stats = profiler.stats
+    assert stats['template child.html'][0] == 2
+    assert stats['block footer (child.html)'][0] == 2
+    assert stats['template index.html'][0] == 2
+    report = profiler.report().splitlines()
+    assert len(report) == len(stats) + 1
+    assert report[1].endswith('template child.html')
+
+    assert '__profile' not in str(Template('{% block a %}{% endblock %}',
+                                           pre_compile=False).code_builder)
@@ -0,0 +1,903 @@
+# -*- coding: utf-8 -*-
+import concurrent.futures
+import http.client
+import io
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from bustard.wsgi_server import (
+    AccessLogger, AsyncioWSGIServer, coalesce_buffers, HTTPRequestError,
+    HTTPRequestParser, InputStream, make_server, SelectorWSGIServer, sendmsg,
+    ThreadPoolWSGIServer, WSGIServer
+)
+from .httpbin import app
+from .utils import CURRENT_DIR
+
+ROOT_DIR = os.path.dirname(CURRENT_DIR)
+
+
+def start_server(application=app, **kwargs):
+    server = make_server(('127.0.0.1', 0), application, **kwargs)
+    thread = threading.Thread(target=server.serve_forever,
+                              kwargs={'poll_interval': 0.05}, daemon=True)
+    thread.start()
+    return server
+
+
+def stop_server(server):
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.yield_fixture
+def server():
+    server = start_server(threads=4)
+    yield server
+    stop_server(server)
+
+
+def raw_request(address, data, timeout=5):
+    """send raw bytes, return all bytes received until server closes"""
+    with socket.create_connection(address[:2], timeout=timeout) as sock:
+        sock.sendall(data)
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    return b''.join(chunks)
+
+
+def request(address, method='GET', url='/get', body=None, headers=None):
+    connection = http.client.HTTPConnection(*address[:2], timeout=5)
+    try:
+        connection.request(method, url, body=body, headers=headers or {})
+        response = connection.getresponse()
+        return response, response.read()
+    finally:
+        connection.close()
+
+
+def test_simple_server():
+    server = start_server()
+    try:
+        response, data = request(server.server_address, url='/get?a=1')
+    finally:
+        stop_server(server)
+    assert response.status == 200
+    assert json.loads(data.decode('utf-8'))['args'] == {'a': '1'}
+
+
+def test_thread_pool(server):
+    assert isinstance(server, ThreadPoolWSGIServer)
+    environ = {}
+
+    def application(env, start_response):
+        environ.update(env)
+        start_response('200 OK', [('Content-Length', '2')])
+        return [b'ok']
+
+    server.set_app(application)
+    response, data = request(server.server_address)
+    assert data == b'ok'
+    assert environ['wsgi.multithread'] is True
+    assert environ['wsgi.multiprocess'] is False
+
+
+def test_concurrent_requests(server):
+    def get(i):
+        url = '/get?i={}'.format(i)
+        response, data = request(server.server_address, url=url)
+        return json.loads(data.decode('utf-8'))['args']['i']
+
+    with concurrent.futures.ThreadPoolExecutor(16) as executor:
+        result = list(executor.map(get, range(200)))
+    assert result == [str(i) for i in range(200)]
+
+
+PREFORK_SCRIPT = '''
+import os, sys
+sys.path.insert(0, {root!r})
+from bustard.wsgi_server import PreforkMaster
+
+def application(environ, start_response):
+    body = str(os.getpid()).encode()
+    start_response('200 OK', [('Content-Length', str(len(body)))])
+    return [body]
+
+master = PreforkMaster(('127.0.0.1', 0), application, workers=2,
+                       graceful_timeout=5)
+print(master.server_address[1], flush=True)
+master.run()
+'''
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires fork')
+def test_prefork():
+    process = subprocess.Popen(
+        [sys.executable, '-c', PREFORK_SCRIPT.format(root=ROOT_DIR)],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    )
+    try:
+        port = int(process.stdout.readline())
+
+        def worker_pids(n=50):
+            return {request(('127.0.0.1', port))[1] for _ in range(n)}
+
+        pids = worker_pids()
+        assert 1 <= len(pids) <= 2
+        # crashed worker is restarted
+        os.kill(int(pids.pop()), signal.SIGKILL)
+        time.sleep(0.5)
+        assert len(worker_pids()) >= 1
+
+        # rolling restart
+        old_pids = worker_pids()
+        process.send_signal(signal.SIGHUP)
+        deadline = time.time() + 10
+        while worker_pids() & old_pids and time.time() < deadline:
+            time.sleep(0.1)
+        assert not worker_pids() & old_pids
+
+        process.send_signal(signal.SIGTERM)
+        assert process.wait(10) == 0
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.stdout.close()
+
+
+RELOAD_SCRIPT = '''
+import os, sys, time
+sys.path.insert(0, {root!r})
+from bustard.wsgi_server import (
+    AsyncioWSGIServer, inherited_fd, make_server, PreforkMaster, run_server,
+    WSGIServer
+)
+
+STARTED = str(time.time())
+
+def application(environ, start_response):
+    body = '{{}} {{}}'.format(os.getpid(), STARTED).encode()
+    start_response('200 OK', [('Content-Length', str(len(body)))])
+    return [body]
+
+if {server_class!r} == 'prefork':
+    master = PreforkMaster(('127.0.0.1', 0), application, workers=2,
+                           graceful_timeout=5, access_logger=False)
+    print(master.server_address[1], flush=True)
+    master.run()
+else:
+    server = make_server(('127.0.0.1', 0), application, fd=inherited_fd(),
+                         server_class={server_class}, access_logger=False)
+    print(server.server_address[1], flush=True)
+    run_server(server)
+'''
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires fork')
+@pytest.mark.parametrize('server_class', ['prefork', 'WSGIServer',
+                                          'AsyncioWSGIServer'])
+def test_reload(server_class):
+    prefork = server_class == 'prefork'
+    process = subprocess.Popen(
+        [sys.executable, '-c',
+         RELOAD_SCRIPT.format(root=ROOT_DIR, server_class=server_class)],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    )
+    responses = []
+    errors = []
+    stop = threading.Event()
+
+    def client(port):
+        while not stop.is_set():
+            try:
+                responses.append(request(('127.0.0.1', port))[1].split())
+            except OSError as ex:
+                errors.append(ex)
+
+    try:
+        port = int(process.stdout.readline())
+        old = {tuple(request(('127.0.0.1', port))[1].split())}
+        thread = threading.Thread(target=client, args=(port,))
+        thread.start()
+        process.send_signal(signal.SIGUSR2)
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            if responses and responses[-1][1] not in {x[1] for x in old}:
+                break
+            time.sleep(0.1)
+        time.sleep(0.5)
+        stop.set()
+        thread.join()
+        # no request failed, the same process serves the new code
+        assert not errors
+        pids, started = zip(*responses[-5:])
+        assert not set(started) & {x[1] for x in old}
+        if prefork:
+            assert not set(pids) & {x[0] for x in old}
+        else:
+            assert set(pids) == {str(process.pid).encode()}
+
+        process.send_signal(signal.SIGTERM)
+        assert process.wait(10) == 0
+    finally:
+        stop.set()
+        if process.poll() is None:
+            process.kill()
+        process.stdout.close()
+
+
+def test_request_parser():
+    parser = HTTPRequestParser()
+    data = (b'POST /a?b=1 HTTP/1.1\r\nHost: x\r\nContent-Length: 5\r\n\r\n'
+            b'helloGET / HTTP/1.0\r\n\r\n'
+            b'PUT / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n'
+            b'3\r\nabc\r\n2;x=y\r\nde\r\n0\r\nA: b\r\n\r\n')
+    requests = []
+    # feed byte by byte
+    for i in range(len(data)):
+        parser.feed(data[i:i + 1])
+        request = parser.next_request()
+        if request is not None:
+            requests.append(request)
+    assert [(x.method, x.path, x.body, x.keep_alive) for x in requests] == [
+        ('POST', '/a?b=1', b'hello', True),
+        ('GET', '/', b'', False),
+        ('PUT', '/', b'abcde', True),
+    ]
+    assert requests[0].headers['Host'] == 'x'
+
+
+@pytest.mark.parametrize('data, status', [
+    (b'GET /\r\n\r\n', '400 Bad Request'),
+    (b'GET / HTTP/2.0\r\n\r\n', '505 HTTP Version Not Supported'),
+    (b'GET / HTTP/1.1\r\nContent-Length: a\r\n\r\n', '400 Bad Request'),
+    (b'GET / HTTP/1.1\r\n' + b'a' * 70000,
+     '431 Request Header Fields Too Large'),
+    (b'POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n'
+     b'Content-Length: 3\r\n\r\n', '400 Bad Request'),
+    (b'POST / HTTP/1.1\r\nContent-Length: 10000000000\r\n\r\n',
+     '413 Payload Too Large'),
+    (b'POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n'
+     b'ffffffffff\r\n', '413 Payload Too Large'),
+])
+def test_request_parser_error(data, status):
+    parser = HTTPRequestParser()
+    parser.feed(data)
+    with pytest.raises(HTTPRequestError) as excinfo:
+        parser.next_request()
+    assert excinfo.value.status == status
+
+
+@pytest.yield_fixture(params=[None, 4], ids=['inline', 'threads'])
+def selector_server(request):
+    server = start_server(server_class=SelectorWSGIServer,
+                          threads=request.param)
+    yield server
+    stop_server(server)
+
+
+def test_selector_server(selector_server):
+    address = selector_server.server_address
+    response, data = request(address, url='/get?a=1')
+    assert json.loads(data.decode('utf-8'))['args'] == {'a': '1'}
+
+    body = b'x' * 200000
+    response, data = request(address, 'POST', '/post', body=body,
+                             headers={'Expect': '100-continue'})
+    assert json.loads(data.decode('utf-8'))['data'] == body.decode()
+
+    # http.client sends iterables with chunked encoding
+    response, data = request(address, 'POST', '/post',
+                             body=iter([b'abc', b'de']))
+    assert json.loads(data.decode('utf-8'))['data'] == 'abcde'
+
+
+def test_selector_server_pipelining(selector_server):
+    data = raw_request(selector_server.server_address, (
+        b'GET /get?i=1 HTTP/1.1\r\nHost: a\r\n\r\n'
+        b'GET /get?i=2 HTTP/1.1\r\nHost: a\r\n\r\n'
+        b'GET /get?i=3 HTTP/1.1\r\nHost: a\r\n'
+        b'Connection: close\r\n\r\n'
+    ))
+    assert data.count(b'HTTP/1.1 200 OK') == 3
+    assert data.index(b'"i": "1"') < data.index(b'"i": "2"') < data.index(
+        b'"i": "3"')
+
+
+def test_selector_server_idle_connections(selector_server):
+    address = selector_server.server_address
+    # idle and slow clients don't block other clients
+    idle = [socket.create_connection(address[:2]) for _ in range(50)]
+    for sock in idle[:25]:
+        sock.sendall(b'GET /get HTTP/1.1\r\nHost')
+    try:
+        for _ in range(5):
+            response, data = request(address)
+            assert response.status == 200
+    finally:
+        for sock in idle:
+            sock.close()
+
+    data = raw_request(address, b'GET /\r\n\r\n')
+    assert data.startswith(b'HTTP/1.1 400 Bad Request\r\n')
+
+
+def echo_port(environ, start_response):
+    # no Content-Length, the server adds it
+    start_response('200 OK', [])
+    return [str(environ['REMOTE_PORT']).encode()]
+
+
+@pytest.yield_fixture(params=[WSGIServer, ThreadPoolWSGIServer,
+                              SelectorWSGIServer, AsyncioWSGIServer])
+def keepalive_server(request):
+    server = start_server(echo_port, server_class=request.param,
+                          keepalive_timeout=0.5, max_keepalive_requests=3)
+    yield server
+    stop_server(server)
+
+
+def test_keepalive(keepalive_server):
+    address = keepalive_server.server_address
+    connection = http.client.HTTPConnection(*address[:2], timeout=5)
+    ports = []
+    for _ in range(4):
+        connection.request('GET', '/')
+        response = connection.getresponse()
+        ports.append(response.read())
+        assert response.getheader('Content-Length') == str(len(ports[-1]))
+    connection.close()
+    # max_keepalive_requests
+    assert response.getheader('Connection') is None
+    assert len(set(ports[:3])) == 1
+    assert ports[3] != ports[0]
+
+    # HTTP/1.0 without keep-alive
+    data = raw_request(address, b'GET / HTTP/1.0\r\n\r\n')
+    assert b'Connection: close\r\n' in data
+
+    # pipelining
+    data = raw_request(address, b'GET / HTTP/1.1\r\n\r\n' * 3)
+    assert data.count(b'HTTP/1.1 200 OK') == 3
+    assert data.count(b'Connection: close') == 1
+
+
+def test_keepalive_timeout(keepalive_server):
+    address = keepalive_server.server_address
+    with socket.create_connection(address[:2], timeout=5) as sock:
+        sock.sendall(b'GET / HTTP/1.1\r\n\r\n')
+        assert sock.recv(65536).startswith(b'HTTP/1.1 200 OK')
+        time.sleep(1.2)
+        # closed by server
+        assert sock.recv(65536) == b''
+
+
+def make_input(data, **kwargs):
+    chunks = [data[i:i + 3] for i in range(0, len(data), 3)]
+    buffer = bytearray()
+    return InputStream(buffer, lambda: chunks.pop(0) if chunks else b'',
+                       **kwargs), buffer
+
+
+def test_input_stream():
+    stream, buffer = make_input(b'ab\ncd\nefGET /', content_length=8)
+    assert stream.readline() == b'ab\n'
+    assert stream.readline(1) == b'c'
+    assert list(stream) == [b'd\n', b'ef']
+    assert stream.read() == b''
+    # bytes of next request are left in buffer
+    assert stream.done
+    assert buffer.startswith(b'G')
+
+    stream, buffer = make_input(
+        b'3\r\nab\n\r\n4;ext=1\r\ncdef\r\n0\r\nX-A: 1\r\n\r\nGET',
+        chunked=True
+    )
+    assert stream.readlines() == [b'ab\n', b'cdef']
+    assert stream.done
+    stream, buffer = make_input(b'3\r\nabc\r\n0\r\n\r\n', chunked=True)
+    assert stream.read(2) == b'ab'
+    assert stream.read(10) == b'c'
+
+    stream, buffer = make_input(b'abc', content_length=10)
+    assert stream.read(2) == b'ab'
+    with pytest.raises(ConnectionError):
+        stream.read()
+    stream, buffer = make_input(b'x\r\n', chunked=True)
+    with pytest.raises(HTTPRequestError):
+        stream.read()
+
+
+def upload_size(environ, start_response):
+    # read body in small pieces
+    stream = environ['wsgi.input']
+    size = 0
+    if environ['PATH_INFO'] == '/upload':
+        data = stream.read(1024)
+        while data:
+            size += len(data)
+            data = stream.read(1024)
+    start_response('200 OK', [])
+    return [str(size).encode()]
+
+
+@pytest.yield_fixture(params=[WSGIServer, ThreadPoolWSGIServer])
+def upload_server(request):
+    server = start_server(upload_size, server_class=request.param,
+                          keepalive_timeout=1)
+    yield server
+    stop_server(server)
+
+
+def test_streaming_upload(upload_server):
+    address = upload_server.server_address
+    body = b'x' * (1024 * 1024 + 1)
+    connection = http.client.HTTPConnection(*address[:2], timeout=5)
+    connection.request('POST', '/upload', body=body)
+    assert connection.getresponse().read() == str(len(body)).encode()
+    # chunked
+    connection.request('POST', '/upload', body=iter([body[:100], body]))
+    assert connection.getresponse().read() == str(len(body) + 100).encode()
+    # unread body is skipped, the connection is kept
+    connection.request('POST', '/', body=b'x' * 1000)
+    assert connection.getresponse().read() == b'0'
+    connection.request('POST', '/upload', body=b'abc')
+    assert connection.getresponse().read() == b'3'
+    connection.close()
+
+    # 100 Continue is sent when the app reads body
+    with socket.create_connection(address[:2], timeout=5) as sock:
+        sock.sendall(b'POST /upload HTTP/1.1\r\nContent-Length: 3\r\n'
+                     b'Expect: 100-continue\r\n\r\n')
+        assert sock.recv(65536) == b'HTTP/1.1 100 Continue\r\n\r\n'
+        sock.sendall(b'abc')
+        assert sock.recv(65536).endswith(b'\r\n\r\n3')
+    data = raw_request(address, b'POST / HTTP/1.1\r\n'
+                                b'Content-Length: 3\r\n'
+                                b'Expect: 100-continue\r\n\r\n')
+    assert data.startswith(b'HTTP/1.1 200 OK')
+    assert b'Connection: close' in data
+
+
+class StreamingBody:
+    def __init__(self, event):
+        self.event = event
+        self.closed = threading.Event()
+
+    def __iter__(self):
+        yield b'first'
+        yield b''
+        # wait until the client got the first chunk
+        self.event.wait(5)
+        yield b'second'
+
+    def close(self):
+        self.closed.set()
+
+
+@pytest.yield_fixture(params=[WSGIServer, ThreadPoolWSGIServer])
+def streaming_server(request):
+    server = start_server(server_class=request.param)
+    yield server
+    stop_server(server)
+
+
+def test_streaming_response(streaming_server):
+    address = streaming_server.server_address
+    event = threading.Event()
+    body = StreamingBody(event)
+
+    def application(environ, start_response):
+        write = start_response('200 OK', [])
+        if environ['PATH_INFO'] == '/write':
+            write(b'a')
+            write(b'b')
+            return iter([b'c'])
+        return body
+
+    streaming_server.set_app(application)
+    connection = http.client.HTTPConnection(*address[:2], timeout=5)
+    connection.request('GET', '/')
+    response = connection.getresponse()
+    assert response.getheader('Transfer-Encoding') == 'chunked'
+    assert response.read(5) == b'first'
+    event.set()
+    assert response.read() == b'second'
+    assert body.closed.wait(5)
+
+    connection.request('GET', '/write')
+    assert connection.getresponse().read() == b'abc'
+    connection.close()
+
+    # HTTP/1.0: the end of body is marked by closing the connection
+    data = raw_request(address, b'GET /write HTTP/1.0\r\n'
+                                b'Connection: keep-alive\r\n\r\n')
+    assert b'Connection: close\r\n' in data
+    assert b'Transfer-Encoding' not in data
+    assert data.endswith(b'\r\n\r\nabc')
+    data = raw_request(address, b'HEAD /write HTTP/1.1\r\n'
+                                b'Connection: close\r\n\r\n')
+    assert data.endswith(b'\r\n\r\n')
+
+
+def test_coalesce_buffers():
+    large = b'x' * 2000
+    assert coalesce_buffers([b'a', b'b', large, b'c', b'', b'd']) == [
+        b'ab', large, b'cd'
+    ]
+    assert coalesce_buffers([large], size=10)[0] is large
+    assert coalesce_buffers([]) == []
+
+
+class PartialSocket:
+    """sends at most ``limit`` bytes per call"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.data = b''
+
+    def sendmsg(self, buffers, ancdata=(), flags=0):
+        data = b''.join(bytes(x) for x in buffers)[:self.limit]
+        self.data += data
+        return len(data)
+
+
+def test_sendmsg():
+    sock = PartialSocket(limit=4)
+    buffers = [b'ab', b'cdef', b'', b'ghi']
+    assert sendmsg(sock, buffers) == 4
+    assert [bytes(x) for x in buffers] == [b'ef', b'', b'ghi']
+    while buffers:
+        sendmsg(sock, buffers)
+    assert sock.data == b'abcdefghi'
+    assert sendmsg(sock, []) == 0
+
+
+def file_app(environ, start_response):
+    path, offset, length = environ['QUERY_STRING'].split(',')
+    fp = open(path, 'rb')
+    start_response('200 OK', [])
+    return environ['wsgi.file_wrapper'](
+        fp, offset=int(offset) if offset else None,
+        length=int(length) if length else None
+    )
+
+
+@pytest.yield_fixture(params=[WSGIServer, SelectorWSGIServer])
+def file_server(request):
+    server = start_server(file_app, server_class=request.param)
+    yield server
+    stop_server(server)
+
+
+def test_file_wrapper(file_server, tmpdir, monkeypatch):
+    sendfile_calls = []
+
+    def sendfile(*args):
+        sendfile_calls.append(args)
+        return os_sendfile(*args)
+    os_sendfile = os.sendfile
+    monkeypatch.setattr(os, 'sendfile', sendfile)
+
+    path = tmpdir.join('data')
+    content = os.urandom(1024 * 1024)
+    path.write_binary(content)
+    address = file_server.server_address
+    connection = http.client.HTTPConnection(*address[:2], timeout=5)
+    for offset, length, expected in [
+        ('', '', content),
+        ('100', '1000', content[100:1100]),
+        ('1048000', '1000', content[1048000:]),
+        ('2000000', '', b''),
+    ]:
+        connection.request(
+            'GET', '/?{},{},{}'.format(path, offset, length)
+        )
+        response = connection.getresponse()
+        assert response.getheader('Content-Length') == str(len(expected))
+        assert response.read() == expected
+    connection.close()
+    # SelectorWSGIServer reads the file
+    assert bool(sendfile_calls) == (not isinstance(file_server,
+                                                   SelectorWSGIServer))
+
+
+def test_server_headers(server, monkeypatch):
+    monkeypatch.setattr(time, 'time', lambda: 0.5)
+    headers = server.server_headers()
+    assert headers == (b'Date: Thu, 01 Jan 1970 00:00:00 GMT\r\n'
+                       b'Server: WSGIServer/0.1\r\n')
+    monkeypatch.setattr(time, 'time', lambda: 0.9)
+    assert server.server_headers() is headers
+    monkeypatch.setattr(time, 'time', lambda: 1.0)
+    assert b'00:00:01 GMT' in server.server_headers()
+    monkeypatch.undo()
+
+    response, data = request(server.server_address)
+    assert response.getheader('Server') == 'WSGIServer/0.1'
+    assert response.getheader('Date').endswith(' GMT')
+
+
+class BlockingStream(io.StringIO):
+    def __init__(self):
+        super().__init__()
+        self.event = threading.Event()
+
+    def write(self, data):
+        self.event.wait(5)
+        return super().write(data)
+
+
+def test_access_logger():
+    stream = BlockingStream()
+    logger = AccessLogger(stream, format='{method} {path} {latency:.0f}',
+                          queue_size=2)
+    record = {'method': 'GET', 'path': '/', 'latency': 1.2, 'time': 0}
+    for _ in range(10):
+        logger.log(dict(record))
+    # the writer thread is blocked
+    assert logger.dropped >= 6
+    stream.event.set()
+    logger.close()
+    lines = stream.getvalue().splitlines()
+    assert lines[0] == 'GET / 1'
+    assert len(lines) == 10 - logger.dropped
+
+
+def test_access_log():
+    stream = io.StringIO()
+    logger = AccessLogger(stream, format='{method} {path} {protocol} '
+                                         '{status} {bytes} {user_agent}')
+    server = start_server(access_logger=logger)
+    try:
+        data = raw_request(server.server_address,
+                           b'GET /get?a=1 HTTP/1.1\r\nHost: a\r\n'
+                           b'User-Agent: test\r\n\r\n')
+    finally:
+        stop_server(server)
+    assert stream.getvalue() == (
+        'GET /get?a=1 HTTP/1.1 200 {} test\n'.format(len(data))
+    )
+
+
+@pytest.mark.parametrize('server_class', [WSGIServer, ThreadPoolWSGIServer,
+                                          SelectorWSGIServer,
+                                          AsyncioWSGIServer])
+def test_limits(server_class):
+    server = start_server(echo_port, server_class=server_class, backlog=7,
+                          timeout=0.3, max_connections=2,
+                          max_header_size=100)
+    address = server.server_address
+    try:
+        assert server.request_queue_size == 7
+        data = raw_request(address, b'GET / HTTP/1.1\r\nX-A: ' +
+                           b'a' * 100 + b'\r\n\r\n')
+        assert data.startswith(b'HTTP/1.1 431 ')
+
+        # a stalled client is disconnected after timeout
+        with socket.create_connection(address[:2], timeout=5) as sock:
+            sock.sendall(b'GET / HTTP/1.1\r\n')
+            start = time.time()
+            assert sock.recv(65536) == b''
+            assert time.time() - start < 2
+
+        if server_class is WSGIServer:
+            # connections wait in the backlog while one is handled
+            return
+        # the third connection is rejected
+        idle = [socket.create_connection(address[:2], timeout=5)
+                for _ in range(2)]
+        try:
+            time.sleep(0.1)
+            data = raw_request(address, b'GET / HTTP/1.1\r\n\r\n')
+            assert data.startswith(b'HTTP/1.1 503 Service Unavailable')
+        finally:
+            for sock in idle:
+                sock.close()
+        time.sleep(0.5)
+        data = raw_request(address, b'GET / HTTP/1.1\r\n'
+                                    b'Connection: close\r\n\r\n')
+        assert data.startswith(b'HTTP/1.1 200 OK')
+    finally:
+        stop_server(server)
+
+
+def test_thread_pool_max_connections():
+    server = ThreadPoolWSGIServer(('127.0.0.1', 0), threads=2, queue_size=3)
+    try:
+        assert server.max_connections == 5
+    finally:
+        server.server_close()
+
+
+def test_asyncio_server():
+    server = start_server(server_class=AsyncioWSGIServer, threads=1)
+    address = server.server_address
+    try:
+        # idle connections don't use threads
+        idle = [socket.create_connection(address[:2], timeout=5)
+                for _ in range(20)]
+        response, data = request(address, url='/get?a=1')
+        assert json.loads(data.decode('utf-8'))['args'] == {'a': '1'}
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        response, data = request(address, method='POST', url='/post',
+                                 body=iter([b'a=', b'1']), headers=headers)
+        assert json.loads(data.decode('utf-8'))['form'] == {'a': '1'}
+        for sock in idle:
+            sock.close()
+    finally:
+        stop_server(server)
+
+
+async def asgi_app(scope, receive, send):
+    message = await receive()
+    headers = [(b'x-path', scope['path'].encode())]
+    if scope['query_string'] == b'stream':
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': headers})
+        await send({'type': 'http.response.body', 'body': b'a',
+                    'more_body': True})
+        await send({'type': 'http.response.body', 'body': message['body']})
+        return
+    await send({'type': 'http.response.start', 'status': 201,
+                'headers': headers})
+    await send({'type': 'http.response.body', 'body': message['body']})
+
+
+def test_asgi():
+    server = start_server(asgi_app, server_class=AsyncioWSGIServer)
+    address = server.server_address
+    try:
+        connection = http.client.HTTPConnection(*address[:2], timeout=5)
+        connection.request('POST', '/a%20b', body=b'hello')
+        response = connection.getresponse()
+        assert response.status == 201
+        assert response.getheader('X-Path') == '/a b'
+        assert response.getheader('Content-Length') == '5'
+        assert response.read() == b'hello'
+        connection.request('POST', '/?stream', body=b'bc')
+        response = connection.getresponse()
+        assert response.getheader('Transfer-Encoding') == 'chunked'
+        assert response.read() == b'abc'
+        connection.close()
+    finally:
+        stop_server(server)
+
+
+@pytest.mark.parametrize('server_class', [ThreadPoolWSGIServer,
+                                          SelectorWSGIServer,
+                                          AsyncioWSGIServer])
+def test_graceful_shutdown(server_class):
+    started = threading.Event()
+
+    def application(environ, start_response):
+        if environ['PATH_INFO'] == '/slow':
+            started.set()
+            time.sleep(0.3)
+        start_response('200 OK', [('Content-Length', '4')])
+        return [b'done']
+
+    server = start_server(application, server_class=server_class,
+                          threads=2, keepalive_timeout=0.5)
+    address = server.server_address
+    executor = concurrent.futures.ThreadPoolExecutor(1)
+    try:
+        idle = socket.create_connection(address[:2], timeout=5)
+        idle.sendall(b'GET / HTTP/1.1\r\n\r\n')
+        assert idle.recv(65536).endswith(b'done')
+        slow = executor.submit(raw_request, address,
+                               b'GET /slow HTTP/1.1\r\n\r\n')
+        assert started.wait(5)
+        start = time.time()
+        server.shutdown()
+        assert time.time() - start < 2
+        # the request in progress is finished, connections are closed
+        data = slow.result()
+        assert b'Connection: close\r\n' in data
+        assert data.endswith(b'done')
+        assert idle.recv(65536) == b''
+        idle.close()
+    finally:
+        executor.shutdown()
+        server.server_close()
+
+
+def test_graceful_timeout():
+    def application(environ, start_response):
+        # the client never sends the body
+        body = environ['wsgi.input'].read()
+        start_response('200 OK', [('Content-Length', str(len(body)))])
+        return [body]
+
+    server = start_server(application, threads=2)
+    server.graceful_timeout = 0.3
+    address = server.server_address
+    try:
+        with socket.create_connection(address[:2], timeout=5) as sock:
+            sock.sendall(b'POST / HTTP/1.1\r\nContent-Length: 5\r\n\r\n')
+            time.sleep(0.1)
+            start = time.time()
+            server.shutdown()
+            assert time.time() - start < 2
+            assert sock.recv(65536) == b''
+    finally:
+        server.server_close()
+
+
+@pytest.mark.parametrize('server_class', [WSGIServer, ThreadPoolWSGIServer,
+                                          SelectorWSGIServer,
+                                          AsyncioWSGIServer])
+def test_application_error(server_class):
+    def application(environ, start_response):
+        raise ValueError('error')
+
+    server = start_server(application, server_class=server_class)
+    try:
+        data = raw_request(server.server_address, b'GET / HTTP/1.1\r\n\r\n')
+    finally:
+        stop_server(server)
+    assert data.startswith(b'HTTP/1.1 500 Internal Server Error\r\n')
+
+
+@pytest.mark.parametrize('threads', [None, 2])
+def test_selector_pipelining(threads):
+    server = start_server(echo_port, server_class=SelectorWSGIServer,
+                          threads=threads, max_keepalive_requests=10000)
+    try:
+        with socket.create_connection(server.server_address[:2],
+                                      timeout=5) as sock:
+            sock.sendall(b'GET / HTTP/1.1\r\n\r\n' * 2000)
+            data = b''
+            while data.count(b'HTTP/1.1 200 OK') < 2000:
+                chunk = sock.recv(65536)
+                assert chunk
+                data += chunk
+    finally:
+        stop_server(server)
+
+
+@pytest.mark.parametrize('server_class', [SelectorWSGIServer,
+                                          AsyncioWSGIServer])
+def test_max_body_size(server_class):
+    server = start_server(echo_port, server_class=server_class,
+                          max_body_size=10)
+    address = server.server_address
+    try:
+        data = raw_request(address, b'POST / HTTP/1.1\r\n'
+                           b'Content-Length: 10\r\nConnection: close\r\n'
+                           b'\r\n' + b'a' * 10)
+        assert data.startswith(b'HTTP/1.1 200 OK')
+        data = raw_request(address, b'POST / HTTP/1.1\r\n'
+                           b'Content-Length: 11\r\n\r\n')
+        assert data.startswith(b'HTTP/1.1 413 Payload Too Large')
+        data = raw_request(address, b'POST / HTTP/1.1\r\n'
+                           b'Transfer-Encoding: chunked\r\n\r\n'
+                           b'6\r\naaaaaa\r\n6\r\n')
+        assert data.startswith(b'HTTP/1.1 413 Payload Too Large')
+    finally:
+        stop_server(server)
+
+
+@pytest.mark.parametrize('server_class', [WSGIServer, ThreadPoolWSGIServer,
+                                          SelectorWSGIServer,
+                                          AsyncioWSGIServer])
+def test_ambiguous_body_length(server_class):
+    server = start_server(echo_port, server_class=server_class)
+    try:
+        data = raw_request(server.server_address, b'POST / HTTP/1.1\r\n'
+                           b'Transfer-Encoding: chunked\r\n'
+                           b'Content-Length: abc\r\n\r\n0\r\n\r\n')
+    finally:
+        stop_server(server)
+    assert data.startswith(b'HTTP/1.1 400 Bad Request')